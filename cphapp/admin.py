@@ -1,7 +1,13 @@
 from django.contrib import admin
 
-from cphapp.models import (LoadOutlet, LoadTransaction, Device)
+from cphapp.models import (
+    LoadOutlet, LoadTransaction, Device, MonthlySales, OutboxEvent,
+    OutletPrefix, SyncCheckpoint)
 
 admin.site.register(LoadOutlet)
 admin.site.register(LoadTransaction)
 admin.site.register(Device)
+admin.site.register(MonthlySales)
+admin.site.register(OutboxEvent)
+admin.site.register(OutletPrefix)
+admin.site.register(SyncCheckpoint)
@@ -37,7 +37,7 @@ class TransactionSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = LoadTransaction
-        fields = '__all__'
+        exclude = ('month_to_date',)
 
     @staticmethod
     def get_user_agent(ua_dict):
@@ -73,7 +73,7 @@ class LoadTransactionSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = LoadTransaction
-        fields = '__all__'
+        exclude = ('month_to_date',)
 
     def __init__(self, instance=None, data=empty, **kwargs):
         '''
@@ -118,7 +118,7 @@ class LoadTransactionSerializer(serializers.ModelSerializer):
                 retailer = Retailer.objects.get(
                     user__username=retailer_username)
             except Retailer.DoesNotExist:
-                return None
+                pass
             else:
                 return retailer.id
 
@@ -135,7 +135,14 @@ class LoadTransactionSerializer(serializers.ModelSerializer):
             return device.owner.id if device.owner is not None else None
 
     @staticmethod
-    def order_to_transactions_map(data):
+    def order_to_transactions_map(data, resolver=None):
+        """
+        Map coins.ph order data to LoadTransaction fields. resolver provides
+        get_user_agent() and get_retailer(), it defaults to this class which
+        looks up (or creates) the device and retailer with a query each.
+        """
+
+        resolver = resolver or LoadTransactionSerializer
         parsed = {
             'id': data.get('transaction_id') or uuid4().hex,
             'order_id': data.get('id'),
@@ -151,14 +158,14 @@ class LoadTransactionSerializer(serializers.ModelSerializer):
                 pytz.timezone(settings.TIME_ZONE)).isoformat(),
             'balance': data.get('running_balance'),
             'posted_amount': data.get('posted_amount'),
-            'device': LoadTransactionSerializer.get_user_agent(
+            'device': resolver.get_user_agent(
                 data.get('user_agent')).id if data.get('user_agent') else None
         }
         if data.get('transaction_type') == 'sellorder':
             parsed.update({
                 'phone_number': data.get('phone_number_load',
                                          data.get('gaming_pin_mobile_number')),
-                'retailer': LoadTransactionSerializer.get_retailer(data)
+                'retailer': resolver.get_retailer(data)
             })
         else:
             parsed['payment_method'] = data.get('payment_outlet_id')
@@ -206,3 +213,21 @@ class LoadTransactionSerializer(serializers.ModelSerializer):
                 err = LoadAmountError(amount, mn, mx)
                 raise serializers.ValidationError(detail=err)
         return super().validate(attrs)
+
+
+class OrderIngestSerializer(LoadTransactionSerializer):
+    """
+    Field rules of LoadTransactionSerializer for orders ingested in bulk.
+    The device and retailer come from the resolver passed in and duplicates
+    are skipped by bulk_create, so neither is looked up per row.
+    """
+
+    class Meta(LoadTransactionSerializer.Meta):
+        exclude = ('month_to_date', 'id', 'device', 'retailer')
+        extra_kwargs = {'order_id': {'validators': []}}
+
+    def __init__(self, data, resolver=None, **kwargs):
+        # Always coins.ph order data, mapped with the batch resolver
+        serializers.ModelSerializer.__init__(
+            self, data=self.order_to_transactions_map(data, resolver),
+            **kwargs)
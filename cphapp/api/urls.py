@@ -1,14 +1,17 @@
 from django.urls import include, path
 from rest_framework.routers import DefaultRouter
 
-from cphapp.api.views import ProductAPIView, TransactionAPIViewset
+from cphapp.api.views import (
+    ProductAPIView, TransactionAPIViewset, UpstreamStatusAPIView)
 
 router = DefaultRouter()
 router.register('transactions', TransactionAPIViewset, basename='transactions')
 
 urlpatterns = [
     path('', include(router.urls)),
-    path('buy-product/', ProductAPIView.as_view(), name='buy-product')
+    path('buy-product/', ProductAPIView.as_view(), name='buy-product'),
+    path('upstream-status/', UpstreamStatusAPIView.as_view(),
+         name='upstream-status'),
     # path('payout-outlets/<slug:outlet_id>/',
     #      PayoutOutletAPIView.as_view(), name='payout-outlets-detail')
 ]
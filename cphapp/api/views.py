@@ -1,24 +1,28 @@
 import logging
+from math import ceil
 from uuid import uuid4
 
-from django.db.models import Q
+from django.conf import settings
 from django.http import QueryDict
 
 from rest_framework import serializers
 from rest_framework import mixins, status, viewsets
 from rest_framework.views import APIView
 from rest_framework.response import Response
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
 from django_filters import rest_framework as filters
 
-from cphapp.models import LoadOutlet, LoadTransaction
+from cphapp.models import LoadTransaction, OutletPrefix
 from cphapp.api.serializers import (
     LoadOutletSerializer, LoadTransactionSerializer)
 from cphapp.filters import TransactionsFilter
-from cphapp.tasks import update_order_data
+from cphapp.pagination import TransactionPagination
 from cphapp.utility import update_outlet_data
+from cphapp.upstream import FAMILIES, request_new_order
+from cphapp.exceptions import (
+    RateLimitError, ServiceTemporaryUnavailableError)
+from cphapp import circuitbreaker, pending, ratelimit, session
 
-from cph.coinsph import request_new_order
 
 logger = logging.getLogger(__name__)
 
@@ -33,21 +37,18 @@ class TransactionAPIViewset(viewsets.GenericViewSet,
     queryset = LoadTransaction.objects.all()
     filter_backends = [filters.DjangoFilterBackend]
     filterset_class = TransactionsFilter
+    pagination_class = TransactionPagination
 
     def get_queryset(self):
+        # Fields computed per row by the serializer are annotated here so a
+        # page costs the same number of queries regardless of its size
+        queryset = super().get_queryset().with_serializer_fields()
         if self.request.user.is_staff:
-            return super().get_queryset()
+            return queryset
 
-        sellorders = super().get_queryset().filter(
-            transaction_type='sellorder')
-
-        retailer_device_list = self.request.user.profile.devices.all()
-        if not retailer_device_list.exists():
-            return self.request.user.profile.load_transactions.all()
-
-        return sellorders.filter(
-            Q(retailer=self.request.user.profile) |
-            Q(device__in=retailer_device_list))
+        # Transactions are bound to their retailer on ingestion and when a
+        # device changes owner (see Device.save)
+        return queryset.filter(retailer_id=self.request.user.profile.id)
 
     def list(self, request, *args, **kwargs):
         # sync_order_db('sellorder')
@@ -82,7 +83,18 @@ class TransactionAPIViewset(viewsets.GenericViewSet,
         if raw_data.get('product_code', False):
             data['product_code'] = raw_data.get('product_code')
 
-        resp = request_new_order(data)
+        try:
+            resp = request_new_order(
+                data, timeout=settings.COINSPH_NEW_ORDER_TIMEOUT)
+        except RateLimitError as e:
+            return Response(data={'detail': str(e)},
+                            status=status.HTTP_429_TOO_MANY_REQUESTS)
+        except ServiceTemporaryUnavailableError as e:
+            headers = {}
+            if getattr(e, 'retry_after', None):
+                headers['Retry-After'] = str(ceil(e.retry_after))
+            return Response(data={'detail': str(e)}, headers=headers,
+                            status=status.HTTP_503_SERVICE_UNAVAILABLE)
         resp_data = resp.json()
         order_data = resp_data.get('order')
 
@@ -103,7 +115,7 @@ class TransactionAPIViewset(viewsets.GenericViewSet,
                 # TODO: send notification alert to admin
                 raise serializers.ValidationError(serializer.error_messages)
             serializer.save()
-            update_order_data.apply_async(kwargs={'id': transaction_id})
+            pending.register(transaction_id)
             return Response(data=resp_data, status=status.HTTP_201_CREATED)
 
         else:
@@ -120,12 +132,20 @@ class ProductAPIView(APIView):
 
     def get(self, request, *args, **kwargs):
         phone_number = request.GET.get('phone_number')
-        prefix = phone_number[:6]
-        try:
-            outlet = LoadOutlet.objects.get(
-                phone_number_prefixes__contains=[prefix])
-        except LoadOutlet.DoesNotExist:
+        outlet = OutletPrefix.get_outlet(phone_number)
+        if outlet is None:
             outlet = update_outlet_data(phone_number)
 
         s = LoadOutletSerializer(instance=outlet)
         return Response(s.data)
+
+
+class UpstreamStatusAPIView(APIView):
+    """ State of the shared coins.ph client, for monitoring """
+
+    permission_classes = [IsAdminUser]
+
+    def get(self, request, *args, **kwargs):
+        return Response({'rate_limits': ratelimit.levels(),
+                         'circuits': circuitbreaker.states(FAMILIES),
+                         'http': session.metrics()})
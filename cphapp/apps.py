@@ -7,5 +7,8 @@ class CphappConfig(AppConfig):
 
     def ready(self):
         import cph
+        import cph.coinsph
         import cphapp.signals
+        from cphapp import session
+        session.install()
         return super().ready()
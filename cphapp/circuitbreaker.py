@@ -0,0 +1,156 @@
+"""
+Circuit breakers in redis shared by every web and Celery worker, one per
+coins.ph endpoint family. After COINSPH_CIRCUIT_BREAKER['failure_threshold']
+failures the circuit opens and calls fail fast with CircuitOpenError. Once
+open_seconds have passed a single probe call is let through (half-open),
+its outcome closes or re-opens the circuit.
+"""
+import logging
+from time import time
+
+from django.conf import settings
+
+from cphapp import redis
+from cphapp.exceptions import CircuitOpenError
+
+logger = logging.getLogger(__name__)
+
+# IDs used in redis db 1
+CIRCUIT_STATE = 'circuit.{}'
+CIRCUIT_PROBE = 'circuit.{}.probe'
+
+# Circuit states
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+# Returns whether the call may go ahead, the state before and after and
+# the seconds until another call may be attempted.
+_ALLOW_SCRIPT = redis.register_script("""
+local now = tonumber(ARGV[1])
+local open_seconds = tonumber(ARGV[2])
+local state = redis.call('hget', KEYS[1], 'state') or 'closed'
+if state == 'closed' then
+    return {1, state, state, '0'}
+end
+local opened_at = tonumber(redis.call('hget', KEYS[1], 'opened_at')) or 0
+local wait = opened_at + open_seconds - now
+if state == 'open' and wait > 0 then
+    redis.call('hincrby', KEYS[1], 'rejected', 1)
+    return {0, state, state, tostring(wait)}
+end
+if redis.call('set', KEYS[2], '1', 'NX', 'PX', ARGV[3]) then
+    redis.call('hset', KEYS[1], 'state', 'half-open')
+    redis.call('hincrby', KEYS[1], 'probes', 1)
+    return {1, state, 'half-open', '0'}
+end
+redis.call('hincrby', KEYS[1], 'rejected', 1)
+return {0, state, 'half-open', tostring(redis.call('pttl', KEYS[2]) / 1000)}
+""")
+
+# Records the outcome of a call, returns the state before and after
+_RECORD_SCRIPT = redis.register_script("""
+local now = tonumber(ARGV[2])
+local state = redis.call('hget', KEYS[1], 'state') or 'closed'
+if ARGV[1] == '1' then
+    if state == 'half-open' then
+        redis.call('hset', KEYS[1], 'state', 'closed', 'failures', 0)
+        redis.call('del', KEYS[2])
+        return {state, 'closed'}
+    elseif state == 'closed'
+            and redis.call('hget', KEYS[1], 'failures') ~= '0' then
+        redis.call('hset', KEYS[1], 'failures', 0)
+    end
+    -- A call let through before the circuit opened does not close it
+    return {state, state}
+end
+redis.call('hincrby', KEYS[1], 'failed', 1)
+if state == 'open' then
+    return {state, state}
+end
+local failures = 1
+local failed_at = tonumber(redis.call('hget', KEYS[1], 'failed_at')) or 0
+if now - failed_at <= tonumber(ARGV[4]) then
+    failures = (tonumber(redis.call('hget', KEYS[1], 'failures')) or 0) + 1
+end
+if state == 'half-open' or failures >= tonumber(ARGV[3]) then
+    redis.call('hset', KEYS[1], 'state', 'open', 'opened_at', ARGV[2],
+               'failures', 0, 'failed_at', ARGV[2])
+    redis.call('hincrby', KEYS[1], 'opened', 1)
+    redis.call('del', KEYS[2])
+    return {state, 'open'}
+end
+redis.call('hset', KEYS[1], 'failures', failures, 'failed_at', ARGV[2])
+return {state, state}
+""")
+
+
+def _keys(family):
+    return [CIRCUIT_STATE.format(family), CIRCUIT_PROBE.format(family)]
+
+
+def _log_transition(family, before, after):
+    if before != after:
+        logger.warning('coins.ph %s circuit %s -> %s', family, before, after)
+
+
+def allow(family):
+    """
+    Raise CircuitOpenError unless a call of family may go ahead. Returns
+    whether the call is the half-open probe, whose outcome must be
+    recorded, or the probe released, for another call to be let through.
+    """
+
+    config = settings.COINSPH_CIRCUIT_BREAKER
+    allowed, before, after, wait = _ALLOW_SCRIPT(
+        keys=_keys(family),
+        args=[repr(time()), config['open_seconds'],
+              int(config['probe_timeout'] * 1000)])
+    _log_transition(family, before.decode(), after.decode())
+    if not allowed:
+        raise CircuitOpenError(family, float(wait))
+    return after.decode() == HALF_OPEN
+
+
+def release(family):
+    """ Let the next call probe again, the probe's outcome says nothing """
+    redis.delete(CIRCUIT_PROBE.format(family))
+
+
+def record(family, success):
+    config = settings.COINSPH_CIRCUIT_BREAKER
+    before, after = _RECORD_SCRIPT(
+        keys=_keys(family),
+        args=[int(success), repr(time()), config['failure_threshold'],
+              config['failure_window']])
+    _log_transition(family, before.decode(), after.decode())
+
+
+def retry_after(family):
+    """ Seconds until a call of family may be attempted, 0 if closed """
+
+    state, opened_at = redis.hmget(CIRCUIT_STATE.format(family),
+                                   'state', 'opened_at')
+    if state is None or state.decode() == CLOSED:
+        return 0
+    return max(float(opened_at or 0)
+               + settings.COINSPH_CIRCUIT_BREAKER['open_seconds'] - time(), 0)
+
+
+def states(families):
+    """ State and counters of the circuit of every family """
+
+    result = {}
+    for family in families:
+        data = {k.decode(): v.decode() for k, v in redis.hgetall(
+            CIRCUIT_STATE.format(family)).items()}
+        result[family] = {
+            'state': data.get('state', CLOSED),
+            'retry_after': round(retry_after(family), 3),
+            'failures': int(data.get('failures', 0)),
+            # Counters since the circuit was first used
+            'failed': int(data.get('failed', 0)),
+            'rejected': int(data.get('rejected', 0)),
+            'opened': int(data.get('opened', 0)),
+            'probes': int(data.get('probes', 0))}
+    return result
@@ -41,6 +41,17 @@ class ServiceTemporaryUnavailableError(Exception):
                 'Please try again in a little while.')
 
 
+class CircuitOpenError(ServiceTemporaryUnavailableError):
+    def __init__(self, family, retry_after) -> None:
+        self.family = family
+        self.retry_after = retry_after
+        super().__init__({'status': 503})
+
+    def __str__(self) -> str:
+        return (f'Calls to coins.ph {self.family} are suspended for '
+                f'{self.retry_after:.0f}s after repeated failures.')
+
+
 class OrderStatusError(Exception):
 
     def __init__(self, status, eti, *args, **kwargs):
@@ -61,3 +72,24 @@ class CryptoPaymentThrottlingError(Exception):
     def __str__(self):
         return ('HTTP_429_TOO_MANY_REQUESTS occurred while fetching '
                 f'{self.order_id} crypto-payment data')
+
+
+class RateLimitError(Exception):
+
+    def __init__(self, family, *args, **kwargs) -> None:
+        self.family = family
+        super().__init__(*args, **kwargs)
+
+    def __str__(self):
+        return f'Rate limit of coins.ph {self.family} calls reached'
+
+
+class RewardsRecomputeBusyError(Exception):
+
+    def __init__(self, months, *args, **kwargs) -> None:
+        self.months = sorted(months)
+        super().__init__(*args, **kwargs)
+
+    def __str__(self):
+        return ('Rewards are being recomputed by another worker, months '
+                f'{self.months} were not rebuilt')
@@ -1,23 +1,59 @@
-from datetime import datetime, timedelta
+from datetime import date, timedelta
+from django import forms
+from django.utils.timezone import localdate
 from django_filters import rest_framework as filters
 from cphapp.models import LoadTransaction
+from cphapp.utils import day_range, month_range
 
+DATE_PARTS = ('transaction_date__year', 'transaction_date__month',
+              'transaction_date__day')
 
-date_range_map = {
-    'today': {
-        'transaction_date__day': datetime.now().day,
-        'transaction_date__month': datetime.now().month,
-        'transaction_date__year': datetime.now().year
-    },
-    'yesterday': {
-        'transaction_date__day': datetime.now().day - 1,
-        'transaction_date__month': datetime.now().month,
-        'transaction_date__year': datetime.now().year
-    }
-}
+
+def date_range_preset(preset):
+    """ [start, end) of a date range preset in local time, as of today """
+
+    today = localdate()
+    if preset == 'today':
+        return day_range(today)
+    if preset == 'yesterday':
+        return day_range(today - timedelta(days=1))
+    if preset == 'this_week':
+        monday = today - timedelta(days=today.weekday())
+        return day_range(monday)[0], day_range(today)[1]
+    if preset == 'this_month':
+        return month_range(today.year, today.month)
+    if preset == 'last_month':
+        last_month = today.replace(day=1) - timedelta(days=1)
+        return month_range(last_month.year, last_month.month)
+    raise ValueError(f'Unknown date range preset {preset}')
+
+
+class TransactionsFilterForm(forms.Form):
+
+    def clean(self):
+        cleaned_data = super().clean()
+        year, month, day = (cleaned_data.get(part) for part in DATE_PARTS)
+        if year is not None and month is None and day is not None:
+            # A day of a year is ambiguous, reject instead of ignoring it
+            self.add_error('transaction_date__day',
+                           'transaction_date__month is required with a day')
+        return cleaned_data
 
 
 class TransactionsFilter(filters.FilterSet):
+    """
+    Every date filter is applied as a half-open transaction_date range in
+    local time so it can use the transaction_date indexes.
+    """
+
+    DATE_RANGE_CHOICES = [
+        ('today', 'Today'),
+        ('yesterday', 'Yesterday'),
+        ('this_week', 'This week'),
+        ('this_month', 'This month'),
+        ('last_month', 'Last month'),
+    ]
+
     td_gte = filters.DateTimeFilter(
         field_name='transaction_date', lookup_expr='gte')
     td_lte = filters.DateTimeFilter(
@@ -26,14 +62,53 @@ class TransactionsFilter(filters.FilterSet):
         field_name='transaction_date', lookup_expr='gte')
     ctd_lte = filters.IsoDateTimeFilter(
         field_name='transaction_date', lookup_expr='lte')
+    date_range = filters.ChoiceFilter(
+        choices=DATE_RANGE_CHOICES, method='filter_date_range')
 
-    def filter_date_lte(self, queryset, name, value):
-        # Add 1 day on the filter date, consider 12:00 AM
-        dt = value + timedelta(hours=23, minutes=59)
-        return queryset.filter(transaction_date__lte=dt)
+    # Applied together in filter_queryset()
+    transaction_date__year = filters.NumberFilter(method='filter_date_part')
+    transaction_date__month = filters.NumberFilter(method='filter_date_part')
+    transaction_date__day = filters.NumberFilter(method='filter_date_part')
 
     class Meta:
         model = LoadTransaction
-        fields = {
-            'transaction_date': ['year', 'month', 'day'],
-        }
+        fields = []
+        form = TransactionsFilterForm
+
+    def filter_date_lte(self, queryset, name, value):
+        # Include the whole filter date, consider 12:00 AM
+        return queryset.filter(transaction_date__lt=value + timedelta(days=1))
+
+    def filter_date_range(self, queryset, name, value):
+        start, end = date_range_preset(value)
+        return queryset.filter(transaction_date__gte=start,
+                               transaction_date__lt=end)
+
+    def filter_date_part(self, queryset, name, value):
+        return queryset
+
+    def filter_queryset(self, queryset):
+        queryset = super().filter_queryset(queryset)
+        year, month, day = (self.form.cleaned_data.get(part)
+                            for part in DATE_PARTS)
+
+        if year is None:
+            # Without a year there is no single range, e.g. month=1 matches
+            # January of every year
+            parts = {part: int(value) for part, value in zip(
+                DATE_PARTS, (year, month, day)) if value is not None}
+            return queryset.filter(**parts)
+
+        try:
+            if month is None:
+                start, _ = month_range(int(year), 1)
+                _, end = month_range(int(year), 12)
+            elif day is None:
+                start, end = month_range(int(year), int(month))
+            else:
+                start, end = day_range(date(int(year), int(month), int(day)))
+        except ValueError:
+            # Not a valid date
+            return queryset.none()
+        return queryset.filter(transaction_date__gte=start,
+                               transaction_date__lt=end)
@@ -0,0 +1,129 @@
+import functools
+import inspect
+import logging
+import threading
+from contextlib import contextmanager
+from time import monotonic, sleep
+from uuid import uuid4
+
+from cphapp import redis
+
+logger = logging.getLogger(__name__)
+
+LEASE_POLL_INTERVAL = 0.5  # seconds
+
+# Only delete the key if it is still held by the given token
+_RELEASE_SCRIPT = redis.register_script("""
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+""")
+
+# Only extend the key if it is still held by the given token
+_RENEW_SCRIPT = redis.register_script("""
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+""")
+
+
+class Lease:
+    """
+    Redis lock held by a single owner that expires after ttl milliseconds
+    unless released, so a crashed owner never blocks the others for good.
+    """
+
+    def __init__(self, name, ttl=30000):
+        self.name = name
+        self.ttl = ttl
+        self.token = uuid4().hex
+
+    def acquire(self):
+        return bool(redis.set(self.name, self.token, nx=True, px=self.ttl))
+
+    def renew(self):
+        return bool(_RENEW_SCRIPT(keys=[self.name],
+                                  args=[self.token, self.ttl]))
+
+    def release(self):
+        released = bool(_RELEASE_SCRIPT(keys=[self.name], args=[self.token]))
+        if not released:
+            logger.warning('Lease %s expired before it was released',
+                           self.name)
+        return released
+
+
+class LeaseHeartbeat(threading.Thread):
+    """ Renews a lease every third of its ttl until stopped """
+
+    def __init__(self, lease):
+        super().__init__(name=f'lease-{lease.name}', daemon=True)
+        self.lease = lease
+        self.lost = False
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.lease.ttl / 3000):
+            if not self.lease.renew():
+                self.lost = True
+                logger.error('Lease %s was lost, another worker may have '
+                             'taken over', self.lease.name)
+                return
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+
+@contextmanager
+def hold(name, ttl=60000, wait=None):
+    """
+    Hold the lease name for the duration of the block, renewed in the
+    background so the block may outlive ttl. Yields the lease, or None if
+    it is still held elsewhere after waiting wait seconds.
+    """
+
+    lease = Lease(name, ttl)
+    deadline = monotonic() + (wait or 0)
+    while not lease.acquire():
+        if monotonic() >= deadline:
+            yield None
+            return
+        sleep(LEASE_POLL_INTERVAL)
+
+    heartbeat = LeaseHeartbeat(lease)
+    heartbeat.start()
+    try:
+        yield lease
+    finally:
+        heartbeat.stop()
+        if not heartbeat.lost:
+            lease.release()
+
+
+def single_instance(name, ttl=60000, wait=None, skipped=None):
+    """
+    Run the decorated function (or Celery task) under the lease name,
+    formatted with the call arguments, e.g. 'lock.backfill.{order_type}'.
+    A call finding the lease held elsewhere for wait seconds is skipped
+    and returns skipped.
+    """
+
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            arguments = signature.bind(*args, **kwargs)
+            arguments.apply_defaults()
+            lease_name = name.format(**arguments.arguments)
+            with hold(lease_name, ttl, wait) as lease:
+                if lease is None:
+                    logger.info('%s is held by another worker, skipping %s',
+                                lease_name, func.__name__)
+                    return skipped
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+from cphapp.tasks import backfill_orders
+
+
+class Command(BaseCommand):
+    help = ('Import the full coins.ph order history using parallel shard '
+            'tasks. Running it again resumes an interrupted backfill.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'order_types', nargs='*', default=['sellorder', 'buyorder'])
+        parser.add_argument('--shard-size', type=int, default=2000)
+        parser.add_argument(
+            '--restart', action='store_true',
+            help='Discard the progress of a previous backfill')
+
+    def handle(self, *args, **options):
+        for order_type in options['order_types']:
+            backfill_orders.delay(
+                order_type, options['shard_size'], options['restart'])
+            self.stdout.write(f'{order_type} backfill queued')
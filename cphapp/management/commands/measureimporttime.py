@@ -0,0 +1,45 @@
+import os
+import subprocess
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# What every web worker and management command loads
+CODE = ('import django; django.setup(); '
+        'import eload.urls, cphapp.tasks, fcm.tasks')
+
+
+class Command(BaseCommand):
+    help = ('Measure the import time of the web and worker modules with '
+            'python -X importtime in a fresh interpreter')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--top', type=int, default=15,
+                            help='Slowest top level imports to list')
+        parser.add_argument('--budget', type=float,
+                            help='Fail if the total exceeds these seconds')
+
+    def handle(self, *args, **options):
+        result = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', CODE],
+            cwd=settings.BASE_DIR, stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE, universal_newlines=True, check=True,
+            env=dict(os.environ, DJANGO_SETTINGS_MODULE='eload.settings'))
+
+        top_level = []
+        for line in result.stderr.splitlines():
+            if not line.startswith('import time:') or '[us]' in line:
+                continue
+            cumulative, name = line.split('|')[1:]
+            if not name[1:].startswith(' '):
+                top_level.append((int(cumulative), name.strip()))
+
+        total = sum(cumulative for cumulative, _ in top_level) / 1e6
+        for cumulative, name in sorted(top_level, reverse=True)[
+                :options['top']]:
+            self.stdout.write(f'{cumulative / 1e6:8.3f}s  {name}')
+        self.stdout.write(f'Total {total:.3f}s')
+        if options['budget'] is not None and total > options['budget']:
+            raise CommandError(
+                f'Import time {total:.3f}s over {options["budget"]}s')
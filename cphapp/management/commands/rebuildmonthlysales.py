@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+from cphapp.models import MonthlySales
+
+
+class Command(BaseCommand):
+    help = ('Check the MonthlySales ledger against the LoadTransaction table '
+            'and rebuild the months that do not match')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--year', type=int)
+        parser.add_argument('--month', type=int)
+        parser.add_argument(
+            '--check', action='store_true',
+            help='Only report mismatches, do not write anything')
+
+    def handle(self, *args, **options):
+        year, month = options['year'], options['month']
+        if (year is None) != (month is None):
+            self.stderr.write('--year and --month must be used together')
+            return
+
+        mismatches, stale = MonthlySales.rebuild(
+            year, month, dry_run=options['check'])
+
+        for year, month, ledger_amount, actual_amount in mismatches:
+            self.stdout.write(
+                f'{year}-{month:02d}: ledger {ledger_amount}, '
+                f'actual {actual_amount}')
+        self.stdout.write(f'{len(mismatches)} month(s) mismatched, '
+                          f'{stale} transaction(s) with stale month_to_date')
+        if not options['check'] and (mismatches or stale):
+            self.stdout.write(self.style.SUCCESS('Ledger rebuilt'))
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+from cphapp.models import OutletPrefix
+
+
+class Command(BaseCommand):
+    help = ('Rebuild the phone number prefix index from '
+            'LoadOutlet.phone_number_prefixes, dropping duplicate prefixes')
+
+    def handle(self, *args, **options):
+        OutletPrefix.rebuild()
+        self.stdout.write(
+            f'{OutletPrefix.objects.count()} prefix(es) indexed')
@@ -0,0 +1,61 @@
+from django.core.management.base import BaseCommand
+from cphapp.standin import StandIn, make_server
+
+
+class Command(BaseCommand):
+    help = ('Serve synthetic coins.ph orders, crypto-payments and '
+            'payout-outlets locally for load testing. Point the app at it '
+            'with COINSPH_BASE_URL=http://<addr>:<port>')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--addr', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8900)
+        parser.add_argument('--orders', type=int, default=10000,
+                            help='Synthetic order history size')
+        parser.add_argument('--days', type=int, default=90,
+                            help='Days the order history spans')
+        parser.add_argument('--retailers', default='',
+                            help='Comma separated retailer usernames set '
+                                 'in order references')
+        parser.add_argument('--latency', type=float, default=0,
+                            help='Seconds added to every response')
+        parser.add_argument('--jitter', type=float, default=0,
+                            help='Random +/- seconds added to the latency')
+        parser.add_argument('--throttle-rate', type=float, default=0,
+                            help='Share of requests answered with a 429')
+        parser.add_argument('--error-rate', type=float, default=0,
+                            help='Share of requests answered with a 5xx')
+        parser.add_argument('--max-limit', type=int,
+                            help='Cap the page size regardless of limit')
+        parser.add_argument('--drift-rate', type=float, default=0,
+                            help='Share of order list requests that add new '
+                                 'orders on top, shifting the pages')
+        parser.add_argument('--settle-after', type=float, default=5,
+                            help='Seconds until a new order is finalized')
+        parser.add_argument('--expire-rate', type=float, default=0.05,
+                            help='Share of orders that expire')
+        parser.add_argument('--seed', type=int)
+
+    def handle(self, *args, **options):
+        standin = StandIn(
+            orders=options['orders'], days=options['days'],
+            retailers=[r for r in options['retailers'].split(',') if r],
+            latency=options['latency'], jitter=options['jitter'],
+            error_rate=options['error_rate'],
+            throttle_rate=options['throttle_rate'],
+            max_limit=options['max_limit'],
+            drift_rate=options['drift_rate'],
+            settle_after=options['settle_after'],
+            expire_rate=options['expire_rate'], seed=options['seed'])
+        server = make_server(standin, options['addr'], options['port'])
+        self.stdout.write(
+            f'coins.ph stand-in with {len(standin.orders)} orders on '
+            f'http://{options["addr"]}:{options["port"]}/')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            self.stdout.write('Requests: {requests}, throttled: {throttled}, '
+                              'errors: {errors}'.format(**standin.stats))
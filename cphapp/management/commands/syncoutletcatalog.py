@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from cphapp.utility import sync_outlet_catalog
+
+
+class Command(BaseCommand):
+    help = ('Preload the coins.ph payout-outlet catalog into LoadOutlet and '
+            'the phone number prefix index')
+
+    def handle(self, *args, **options):
+        result = sync_outlet_catalog()
+        self.stdout.write(
+            '{created} created, {updated} updated, {unchanged} unchanged, '
+            '{unsupported} unsupported prefix(es)'.format(**result))
@@ -0,0 +1,52 @@
+from django.core.management.base import BaseCommand
+from django.utils.timezone import localtime
+from cphapp.locks import hold
+from cphapp.models import LoadTransaction, get_reward_th
+from cphapp.utility import REWARDS_RECOMPUTE_LOCK, REWARDS_RECOMPUTE_WAIT
+
+
+class Command(BaseCommand):
+    help = 'Recompute reward_amount of settled LoadTransaction objects'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--year', type=int)
+        parser.add_argument('--month', type=int)
+        parser.add_argument(
+            '--limit', type=float,
+            help='Monthly sales limit of the first reward tier')
+        parser.add_argument('--reward-factor', type=float)
+        parser.add_argument('--reward-factor-onwards', type=float)
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Only report the rewards that would change')
+
+    def handle(self, *args, **options):
+        year, month = options['year'], options['month']
+        if (year is None) != (month is None):
+            self.stderr.write('--year and --month must be used together')
+            return
+
+        reward_th = get_reward_th()
+        for key in ('limit', 'reward_factor', 'reward_factor_onwards'):
+            if options[key] is not None:
+                reward_th[key] = options[key]
+
+        if options['dry_run']:
+            diff = LoadTransaction.update_rewards(
+                month, year, reward_th, dry_run=True)
+        else:
+            with hold(REWARDS_RECOMPUTE_LOCK,
+                      wait=REWARDS_RECOMPUTE_WAIT) as lease:
+                if lease is None:
+                    self.stderr.write('Rewards are being recomputed by '
+                                      'another worker, try again later')
+                    return
+                diff = LoadTransaction.update_rewards(month, year, reward_th)
+
+        for order_id, transaction_date, old, new in diff:
+            transaction_date = localtime(transaction_date)
+            self.stdout.write(
+                f'{order_id} - {transaction_date:%Y-%m-%d %I:%M %p} - '
+                f'{old} -> {new}')
+        verb = 'would change' if options['dry_run'] else 'changed'
+        self.stdout.write(f'{len(diff)} reward(s) {verb}')
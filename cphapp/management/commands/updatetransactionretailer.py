@@ -1,19 +1,31 @@
-from django.db.models import Q
+from django.db.models import OuterRef, Subquery
 from django.core.management.base import BaseCommand
-from cphapp.models import LoadTransaction
+from cphapp.models import Device, LoadTransaction
 
 
 class Command(BaseCommand):
-    help = 'Bind LoadTransaction objects to retailer using device_hash'
+    help = 'Bind LoadTransaction objects to retailer using the device owner'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=5000)
 
     def handle(self, *args, **options):
         transactions = LoadTransaction.objects.filter(
-            ~Q(device__device_hash=None),
-            transaction_type='sellorder',
-            retailer=None)
+            transaction_type='sellorder', retailer=None,
+            device__owner__isnull=False).order_by()
+        owner = Device.objects.filter(
+            pk=OuterRef('device_id')).values('owner_id')[:1]
+
+        total = 0
+        while True:
+            # Updated rows drop out of the filter, so always take the first
+            pks = list(transactions.values_list(
+                'pk', flat=True)[:options['chunk_size']])
+            if not pks:
+                break
+            total += LoadTransaction.objects.filter(pk__in=pks).update(
+                retailer=Subquery(owner))
+            self.stdout.write(f'{total} transaction(s) updated')
 
-        for transaction in transactions:
-            retailer = transaction.device.owner
-            transaction.retailer = retailer
-            transaction.save()
-            print(transaction)
+        self.stdout.write(self.style.SUCCESS(
+            f'Done, {total} transaction(s) bound to their retailer'))
@@ -1,14 +1,35 @@
+import json
 import os
+from math import isclose
 from uuid import uuid4
-from django.db import models
+from django.db import models, transaction as db_transaction
+from django.db.models.functions import Coalesce, TruncMonth
 from django.contrib.postgres.fields import ArrayField, JSONField
-from django.utils.timezone import get_current_timezone
+from django.utils.timezone import get_current_timezone, localtime
 from django.conf import settings
 
-from cphapp.utils import utc_to_local
+from cphapp.utils import utc_to_local, month_range
 from profiles.models import Profile as Retailer
 
 
+# Statuses of the transactions that get posted_amount and balance from a
+# crypto-payment
+PAYMENT_DATA_STATUSES = ('settled', 'refunded', 'released')
+
+
+def get_reward_th():
+    """
+    Reward tiers, LOADNINJA_REWARD_TH. The environment variable of the same
+    name, a JSON object, overrides the setting's keys.
+    """
+
+    reward_th = dict(settings.LOADNINJA_REWARD_TH)
+    override = os.getenv('LOADNINJA_REWARD_TH')
+    if override:
+        reward_th.update(json.loads(override))
+    return reward_th
+
+
 class Device(models.Model):
     owner = models.ForeignKey(
         Retailer, on_delete=models.SET_NULL,
@@ -20,9 +41,36 @@ class Device(models.Model):
     device_hash = models.CharField(max_length=70, blank=True)
     user_agent = models.CharField(max_length=200, blank=True)
 
+    # Owner as last loaded from/saved to the DB
+    _db_owner_id = None
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._db_owner_id = instance.__dict__.get('owner_id')
+        return instance
+
     def __str__(self):
         return self.user_agent
 
+    def save(self, *args, **kwargs):
+        with db_transaction.atomic():
+            super().save(*args, **kwargs)
+            if self.owner_id != self._db_owner_id:
+                self.update_transactions_retailer(self._db_owner_id)
+        self._db_owner_id = self.owner_id
+
+    def update_transactions_retailer(self, previous_owner_id=None):
+        """
+        Hand the device's transactions that were bound to it through the
+        previous owner (or to no one) to the current owner.
+        """
+
+        return LoadTransaction.objects.filter(
+            models.Q(retailer=None) | models.Q(retailer=previous_owner_id),
+            device=self, transaction_type='sellorder').update(
+            retailer=self.owner)
+
 
 class LoadOutlet(models.Model):
     id = models.CharField(max_length=20, primary_key=True)
@@ -42,6 +90,380 @@ class LoadOutlet(models.Model):
     def categories(self):
         pass
 
+    def save(self, *args, **kwargs):
+        # Drop duplicate prefixes, keeping the order they were added
+        self.phone_number_prefixes = list(
+            dict.fromkeys(self.phone_number_prefixes))
+        super().save(*args, **kwargs)
+        self.sync_prefixes()
+
+    def add_prefix(self, prefix):
+        if prefix not in self.phone_number_prefixes:
+            self.phone_number_prefixes.append(prefix)
+            self.save()
+
+    def sync_prefixes(self):
+        """ Point OutletPrefix to this outlet for all its prefixes """
+
+        prefixes = set(self.phone_number_prefixes)
+        OutletPrefix.objects.filter(outlet=self).exclude(
+            prefix__in=prefixes).delete()
+        indexed = set(OutletPrefix.objects.filter(
+            outlet=self).values_list('prefix', flat=True))
+        for prefix in prefixes - indexed:
+            OutletPrefix.objects.update_or_create(
+                prefix=prefix, defaults={'outlet': self})
+            # A prefix belongs to one outlet only, take it from the others
+            LoadOutlet.objects.filter(
+                phone_number_prefixes__contains=[prefix]).exclude(
+                pk=self.pk).update(phone_number_prefixes=models.Func(
+                    models.F('phone_number_prefixes'), models.Value(prefix),
+                    function='array_remove'))
+
+
+class OutletPrefix(models.Model):
+    """
+    Phone number prefix to LoadOutlet index. Derived from
+    LoadOutlet.phone_number_prefixes, which is kept for the API output.
+    """
+
+    prefix = models.CharField(max_length=6, primary_key=True)
+    outlet = models.ForeignKey(
+        LoadOutlet, on_delete=models.CASCADE, related_name='prefixes')
+
+    class Meta:
+        verbose_name_plural = 'Outlet prefixes'
+
+    def __str__(self):
+        return f'{self.prefix} - {self.outlet_id}'
+
+    @classmethod
+    def get_outlet(cls, phone_number):
+        try:
+            return cls.objects.select_related('outlet').get(
+                prefix=phone_number[:6]).outlet
+        except cls.DoesNotExist:
+            return None
+
+    @classmethod
+    def rebuild(cls):
+        """ Rebuild the index from LoadOutlet.phone_number_prefixes """
+
+        with db_transaction.atomic():
+            cls.objects.all().delete()
+            for outlet in LoadOutlet.objects.all():
+                outlet.save()
+
+
+class MonthlySales(models.Model):
+    """
+    Running total of settled transactions per local calendar month. Kept up
+    to date by LoadTransaction.save() so the monthly sales used for the
+    reward tier never has to be aggregated from the raw table.
+    """
+
+    class Meta:
+        verbose_name_plural = 'Monthly sales'
+        unique_together = ('year', 'month')
+        ordering = ('-year', '-month')
+
+    year = models.PositiveSmallIntegerField()
+    month = models.PositiveSmallIntegerField()
+    amount = models.FloatField(default=0)
+    count = models.PositiveIntegerField(default=0)
+    # Latest settled transaction_date posted, used to detect late arrivals
+    last_transaction_date = models.DateTimeField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f'{self.year}-{self.month:02d} - {self.amount}'
+
+    @classmethod
+    def _get_for_update(cls, transaction):
+        transaction_date = localtime(transaction.transaction_date)
+        return cls.objects.select_for_update().get_or_create(
+            year=transaction_date.year, month=transaction_date.month)[0]
+
+    @classmethod
+    def _shift_later(cls, transaction, amount):
+        """
+        Add amount to the month_to_date of the posted transactions of the
+        month from transaction on and recompute their reward. Returns them.
+        """
+
+        transaction_date = localtime(transaction.transaction_date)
+        _, end = month_range(transaction_date.year, transaction_date.month)
+        later = list(LoadTransaction.objects.settled().filter(
+            transaction_date__gte=transaction.transaction_date,
+            transaction_date__lt=end).exclude(month_to_date=None).exclude(
+            pk=transaction.pk).only(
+            'id', 'transaction_type', 'status', 'amount', 'balance',
+            'reward_amount', 'month_to_date', 'transaction_date'))
+        reward_th = get_reward_th()
+        for t in later:
+            t.month_to_date += amount
+            if t.earns_reward:
+                t.reward_amount = t.amount * LoadTransaction.get_reward_factor(
+                    t.month_to_date - t.amount, reward_th)
+        LoadTransaction.objects.bulk_update(
+            later, ['month_to_date', 'reward_amount'], batch_size=500)
+        return later
+
+    @classmethod
+    def post(cls, transaction):
+        """
+        Add a newly settled transaction to its month and set its
+        month_to_date. Must be called inside a DB transaction.
+        """
+
+        ledger = cls._get_for_update(transaction)
+        transaction_date = transaction.transaction_date
+        if ledger.last_transaction_date is None \
+                or transaction_date > ledger.last_transaction_date:
+            ledger.amount += transaction.amount
+            ledger.last_transaction_date = transaction_date
+            month_to_date = ledger.amount
+        else:
+            # Late arrival (e.g. historical sync). Transactions posted after
+            # it already have a month_to_date that does not include it.
+            later = cls._shift_later(transaction, transaction.amount)
+            ledger.amount += transaction.amount
+            month_to_date = ledger.amount - sum(
+                t.amount for t in later
+                if t.transaction_date > transaction_date)
+
+        ledger.count += 1
+        ledger.save()
+        transaction.month_to_date = month_to_date
+
+    @classmethod
+    def post_new(cls, since=None):
+        """
+        Post the settled transactions inserted in bulk, i.e. without a
+        month_to_date yet, with a transaction_date from since on. They are
+        added oldest first and get their month_to_date and reward. Months
+        where one of them predates the last posted transaction are left for
+        rebuild(), their (year, month) are returned.
+        """
+
+        transactions = LoadTransaction.objects.settled().filter(
+            month_to_date=None).exclude(transaction_date=None)
+        if since is not None:
+            transactions = transactions.filter(transaction_date__gte=since)
+        by_month = {}
+        for transaction in transactions.only(
+                'id', 'transaction_type', 'status', 'amount', 'balance',
+                'reward_amount', 'transaction_date').order_by(
+                'transaction_date'):
+            transaction_date = localtime(transaction.transaction_date)
+            by_month.setdefault(
+                (transaction_date.year, transaction_date.month),
+                []).append(transaction)
+
+        reward_th = get_reward_th()
+        late = set()
+        for key, month_transactions in sorted(by_month.items()):
+            with db_transaction.atomic():
+                ledger = cls._get_for_update(month_transactions[0])
+                if ledger.last_transaction_date is not None \
+                        and month_transactions[0].transaction_date \
+                        <= ledger.last_transaction_date:
+                    late.add(key)
+                    continue
+
+                for transaction in month_transactions:
+                    ledger.amount += transaction.amount
+                    transaction.month_to_date = ledger.amount
+                    if transaction.earns_reward:
+                        transaction.reward_amount = transaction.amount \
+                            * LoadTransaction.get_reward_factor(
+                                ledger.amount - transaction.amount,
+                                reward_th)
+                ledger.count += len(month_transactions)
+                ledger.last_transaction_date = \
+                    month_transactions[-1].transaction_date
+                ledger.save()
+                LoadTransaction.objects.bulk_update(
+                    month_transactions, ['month_to_date', 'reward_amount'],
+                    batch_size=500)
+        return late
+
+    @classmethod
+    def unpost(cls, transaction, amount):
+        """
+        Remove a previously settled transaction (refunded, expired, ...) from
+        its month. Must be called inside a DB transaction.
+        """
+
+        ledger = cls._get_for_update(transaction)
+        ledger.amount -= amount
+        ledger.count -= 1
+        ledger.save()
+
+        cls._shift_later(transaction, -amount)
+        transaction.month_to_date = None
+
+    @classmethod
+    def rebuild(cls, year=None, month=None, dry_run=False):
+        """
+        Recompute the ledger and every month_to_date from the raw table.
+        Returns a list of (year, month, ledger_amount, actual_amount) for
+        the months that did not match and the number of transactions whose
+        month_to_date was stale.
+        """
+
+        transactions = LoadTransaction.objects.settled()
+        if year is not None and month is not None:
+            transactions = transactions.in_month(year, month)
+
+        totals = {}
+        changed = []
+        for transaction in transactions.with_running_sales().order_by(
+                'transaction_date').iterator(chunk_size=2000):
+            transaction_date = localtime(transaction.transaction_date)
+            key = (transaction_date.year, transaction_date.month)
+            amount, count, _ = totals.get(key, (0, 0, None))
+            totals[key] = (amount + transaction.amount, count + 1,
+                           transaction.transaction_date)
+            if transaction.month_to_date is None or not isclose(
+                    transaction.month_to_date, transaction.running_sales,
+                    abs_tol=1e-6):
+                transaction.month_to_date = transaction.running_sales
+                changed.append(transaction)
+
+        ledgers = cls.objects.all()
+        if year is not None and month is not None:
+            ledgers = ledgers.filter(year=year, month=month)
+        ledgers = {(ledger.year, ledger.month): ledger for ledger in ledgers}
+
+        mismatches = []
+        for key in sorted(set(totals) | set(ledgers)):
+            amount, count, last_transaction_date = totals.get(
+                key, (0, 0, None))
+            ledger = ledgers.get(key, cls(year=key[0], month=key[1]))
+            if isclose(ledger.amount, amount, abs_tol=1e-6) \
+                    and ledger.count == count:
+                continue
+            mismatches.append((*key, ledger.amount, amount))
+            if not dry_run:
+                ledger.amount = amount
+                ledger.count = count
+                ledger.last_transaction_date = last_transaction_date
+                ledger.save()
+
+        if not dry_run:
+            LoadTransaction.objects.bulk_update(
+                changed, ['month_to_date'], batch_size=500)
+        return mismatches, len(changed)
+
+
+class SyncCheckpoint(models.Model):
+    """
+    High-water mark of the coins.ph orders synced per order type, plus the
+    progress of the ongoing (or interrupted) sync run.
+    """
+
+    order_type = models.CharField(max_length=10, primary_key=True)
+    # Newest order synced by the last complete run
+    created_time = models.BigIntegerField(null=True, blank=True)
+    order_id = models.CharField(max_length=50, blank=True)
+
+    # Ongoing run: newest order seen, upstream total when it started and
+    # number of orders processed since
+    run_created_time = models.BigIntegerField(null=True, blank=True)
+    run_order_id = models.CharField(max_length=50, blank=True)
+    run_total = models.PositiveIntegerField(null=True, blank=True)
+    run_offset = models.PositiveIntegerField(default=0)
+    # Upstream total on the last page fetched
+    total = models.PositiveIntegerField(null=True, blank=True)
+
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f'{self.order_type} - {self.created_time}'
+
+    def is_newer(self, order):
+        """ Whether an order is not older than the high-water mark """
+
+        if self.created_time is None:
+            return True
+        # Orders created in the same second as the mark may be new, those
+        # already synced are skipped on insert
+        return int(order.get('created_time')) >= self.created_time
+
+    def complete_run(self):
+        if self.run_created_time is not None:
+            self.created_time = self.run_created_time
+            self.order_id = self.run_order_id
+        self.run_created_time = self.run_total = None
+        self.run_order_id = ''
+        self.run_offset = 0
+        self.save()
+
+
+class OutboxEvent(models.Model):
+    """
+    Side effect of a LoadTransaction change, written in the same DB
+    transaction as the change. Drained in batches by tasks.dispatch_outbox.
+    """
+
+    PAYMENT_DATA = 'payment_data'
+    EVENT_TYPES = [(PAYMENT_DATA, 'Fetch payment data')]
+
+    event_type = models.CharField(max_length=30, choices=EVENT_TYPES)
+    order_id = models.CharField(max_length=50)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ('id',)
+
+    def __str__(self):
+        return f'{self.event_type} - {self.order_id}'
+
+
+class LoadTransactionQuerySet(models.QuerySet):
+
+    def settled(self):
+        return self.filter(status='settled')
+
+    def in_month(self, year, month):
+        start, end = month_range(year, month)
+        return self.filter(transaction_date__gte=start,
+                           transaction_date__lt=end)
+
+    def with_running_sales(self):
+        """
+        Annotate the month-to-date sales up to and including each row, in a
+        single window function pass. Call on a settled() queryset.
+        """
+        return self.annotate(running_sales=models.Window(
+            expression=models.Sum('amount'),
+            partition_by=[TruncMonth('transaction_date')],
+            order_by=models.F('transaction_date').asc()))
+
+    def with_serializer_fields(self):
+        """
+        Annotate what LoadTransactionSerializer would otherwise query per
+        row: month-to-date sales of non-settled rows, the outlet name and
+        the device.
+        """
+
+        sold = self.model.objects.settled().filter(
+            transaction_date__gte=models.OuterRef('month_start'),
+            transaction_date__lte=models.OuterRef('transaction_date'))
+        sold = sold.order_by().annotate(total=models.Func(
+            models.F('amount'), function='SUM')).values('total')
+        outlet_name = LoadOutlet.objects.filter(
+            id=models.OuterRef('outlet_id')).values('name')[:1]
+
+        return self.select_related('device').annotate(
+            month_start=TruncMonth('transaction_date'),
+            outlet_name=models.Subquery(outlet_name)).annotate(
+            sales_to_date=Coalesce(
+                'month_to_date',
+                models.Subquery(sold, output_field=models.FloatField()),
+                models.Value(0.0)))
+
 
 class LoadTransaction(models.Model):
     """ Model derived from coins.ph order data. """
@@ -49,6 +471,14 @@ class LoadTransaction(models.Model):
     class Meta:
         verbose_name_plural = 'Load transactions'
         ordering = ('-transaction_date',)
+        indexes = [
+            # Keyset pagination
+            models.Index(fields=['-transaction_date', '-id']),
+            # Retailer scoped list and date range filters
+            models.Index(fields=['retailer', '-transaction_date']),
+        ]
+
+    objects = LoadTransactionQuerySet.as_manager()
 
     # Identity fields
     id = models.UUIDField(primary_key=True, default=uuid4)
@@ -75,6 +505,9 @@ class LoadTransaction(models.Model):
     reward_amount = models.FloatField(default=0, null=True, blank=True)
     top_up_amount = models.FloatField(default=0, null=True, blank=True)
     transaction_date = models.DateTimeField(null=True, blank=True)
+    # Settled sales of the month up to and including this transaction.
+    # Maintained by MonthlySales, None if the transaction is not settled.
+    month_to_date = models.FloatField(null=True, blank=True, editable=False)
 
     # sellorder
     phone_number = models.CharField(max_length=13, null=True, blank=True)
@@ -90,6 +523,17 @@ class LoadTransaction(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    # Status and amount as last loaded from/saved to the DB
+    _db_status = None
+    _db_amount = None
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._db_status = instance.__dict__.get('status')
+        instance._db_amount = instance.__dict__.get('amount')
+        return instance
+
     def __str__(self):
         transaction_date = utc_to_local(
             self.transaction_date, get_current_timezone())
@@ -102,21 +546,65 @@ class LoadTransaction(models.Model):
                 f'{self.transaction_type} - {self.amount}')
 
     @classmethod
-    def update_rewards(cls, month=None, year=None, rth=None):
-        if month is None and year is None:
-            transactions = cls.objects.filter(status='settled')
-        else:
-            transactions = cls.objects.filter(status='settled',
-                                              transaction_date__month=month,
-                                              transaction_date__year=year)
+    def update_rewards(cls, month=None, year=None, rth=None, dry_run=False,
+                       batch_size=500):
+        """
+        Recompute reward_amount of settled transactions in a single ordered
+        pass over the month-to-date sales window and write the changed rows
+        with batched updates. Like save(), only transactions that earn a
+        reward get one, the others keep theirs. Returns (order_id,
+        transaction_date, old_reward_amount, new_reward_amount) for every
+        changed row.
+        """
+
+        transactions = cls.objects.settled()
+        if month is not None and year is not None:
+            transactions = transactions.in_month(year, month)
         if rth is not None:
             reward_th = rth
         else:
-            reward_th = os.getenv('LOADNINJA_REWARD_TH',
-                                  settings.LOADNINJA_REWARD_TH)
-
-        for transaction in transactions.reverse():
-            transaction.update_reward(reward_th)
+            reward_th = get_reward_th()
+
+        transactions = transactions.with_running_sales().only(
+            'id', 'order_id', 'transaction_type', 'status', 'amount',
+            'balance', 'reward_amount', 'month_to_date',
+            'transaction_date').order_by('transaction_date')
+
+        diff = []
+        batch = []
+        for transaction in transactions.iterator(chunk_size=2000):
+            sold = transaction.running_sales
+            if transaction.earns_reward:
+                reward_amount = transaction.amount * cls.get_reward_factor(
+                    sold - transaction.amount, reward_th)
+            else:
+                reward_amount = transaction.reward_amount or 0
+            if transaction.reward_amount is not None \
+                    and transaction.month_to_date is not None \
+                    and isclose(transaction.reward_amount, reward_amount,
+                                abs_tol=1e-6) \
+                    and isclose(transaction.month_to_date, sold,
+                                abs_tol=1e-6):
+                continue
+
+            if transaction.reward_amount is None or not isclose(
+                    transaction.reward_amount, reward_amount, abs_tol=1e-6):
+                diff.append((transaction.order_id,
+                             transaction.transaction_date,
+                             transaction.reward_amount, reward_amount))
+            if dry_run:
+                continue
+            transaction.reward_amount = reward_amount
+            transaction.month_to_date = sold
+            batch.append(transaction)
+            if len(batch) >= batch_size:
+                cls.objects.bulk_update(
+                    batch, ['reward_amount', 'month_to_date'])
+                batch = []
+
+        if batch:
+            cls.objects.bulk_update(batch, ['reward_amount', 'month_to_date'])
+        return diff
 
     def update_reward(self, rth=None):
         # Set reward_amount value
@@ -127,21 +615,37 @@ class LoadTransaction(models.Model):
         if rth is not None:
             reward_th = rth
         else:
-            reward_th = os.getenv('LOADNINJA_REWARD_TH',
-                                  settings.LOADNINJA_REWARD_TH)
-        reward_factor = reward_th['reward_factor'] \
-            if (self.sold_this_month - self.amount) <= reward_th['limit'] \
-            else reward_th['reward_factor_onwards']
+            reward_th = get_reward_th()
+        reward_factor = self.get_reward_factor(
+            self.sold_this_month - self.amount, reward_th)
         self.reward_amount = self.amount * reward_factor
         # Skip reward_amount update on save (a little bit hacky, fix this itf)
         self.save(skip_reward_update=True)
 
+    @staticmethod
+    def get_reward_factor(sold, reward_th):
+        """ Reward factor given the month's sales prior to a transaction """
+        return reward_th['reward_factor'] if sold <= reward_th['limit'] \
+            else reward_th['reward_factor_onwards']
+
     @property
     def is_complete(self):
         return self.balance is not None
 
+    @property
+    def earns_reward(self):
+        """ Settled sellorder whose payment data is in """
+        return self.transaction_type == 'sellorder' \
+            and self.status == 'settled' and self.is_complete
+
     @property
     def sold_this_month(self):
+        if self.month_to_date is not None:
+            return self.month_to_date
+        if 'sales_to_date' in self.__dict__:
+            # Annotated by LoadTransactionQuerySet.with_serializer_fields()
+            return self.sales_to_date
+
         transaction_date = utc_to_local(
             self.transaction_date, get_current_timezone())
         sold_this_month = LoadTransaction.objects.filter(
@@ -153,6 +657,12 @@ class LoadTransaction(models.Model):
 
         return sold_this_month if sold_this_month is not None else 0
 
+    @property
+    def awaits_payment_data(self):
+        """ posted_amount and balance still have to be fetched """
+        return self.status in PAYMENT_DATA_STATUSES \
+            and self.balance is None and bool(self.order_id)
+
     @property
     def running_balance(self):
         if not self.is_complete:
@@ -163,6 +673,9 @@ class LoadTransaction(models.Model):
     def network(self):
         if self.transaction_type != 'sellorder':
             return None
+        if 'outlet_name' in self.__dict__:
+            # Annotated by LoadTransactionQuerySet.with_serializer_fields()
+            return self.outlet_name or ''
         try:
             outlet = LoadOutlet.objects.get(id=self.outlet_id)
         except LoadOutlet.DoesNotExist:
@@ -170,30 +683,58 @@ class LoadTransaction(models.Model):
         else:
             return outlet.name
 
+    def update_top_up_amount(self):
+        if self.transaction_type != 'sellorder' or self.status != 'settled':
+            return
+
+        if self.retailer is not None:
+            # Use retailer settings
+            if self.top_up_amount == 0 \
+                    and self.amount < self.retailer.top_up_th:
+                self.top_up_amount = self.retailer.top_up_amount
+        else:
+            # Apply defaults
+            if self.top_up_amount == 0 and self.amount < 100:
+                self.top_up_amount = 2
+
     def save(self, *args, **kwargs):
-        if self.transaction_type == 'sellorder' and self.status == 'settled':
-            # Set top_up_amount value
-            if self.retailer is not None:
-                # Use retailer settings
-                if self.top_up_amount == 0 \
-                        and self.amount < self.retailer.top_up_th:
-                    self.top_up_amount = self.retailer.top_up_amount
-            else:
-                # Apply defaults
-                if self.top_up_amount == 0 and self.amount < 100:
-                    self.top_up_amount = 2
+        # Set top_up_amount value
+        self.update_top_up_amount()
 
-            # Set reward_amount value
-            try:
-                kwargs.pop('skip_reward_update')
-            except KeyError:
-                if self.is_complete:
-                    reward_th = os.getenv('LOADNINJA_REWARD_TH',
-                                          settings.LOADNINJA_REWARD_TH)
-                    sold = self.sold_this_month - self.amount
-                    reward_factor = reward_th['reward_factor'] \
-                        if sold <= reward_th['limit'] \
-                        else reward_th['reward_factor_onwards']
-                    self.reward_amount = self.amount * reward_factor
+        skip_reward_update = kwargs.pop('skip_reward_update', False)
 
-        super().save(*args, **kwargs)
+        with db_transaction.atomic():
+            self.update_monthly_sales()
+
+            # Set reward_amount value
+            if self.earns_reward and not skip_reward_update:
+                reward_th = get_reward_th()
+                reward_factor = self.get_reward_factor(
+                    self.sold_this_month - self.amount, reward_th)
+                self.reward_amount = self.amount * reward_factor
+
+            super().save(*args, **kwargs)
+
+            if self.awaits_payment_data \
+                    and self._db_status not in PAYMENT_DATA_STATUSES:
+                # Once, on the transition. A save while the data is still
+                # missing (e.g. by apply_payment) must not queue it again.
+                OutboxEvent.objects.create(
+                    event_type=OutboxEvent.PAYMENT_DATA,
+                    order_id=self.order_id)
+
+        self._db_status = self.status
+        self._db_amount = self.amount
+
+    def update_monthly_sales(self):
+        """ Post to/remove from MonthlySales on settlement status change """
+
+        was_settled = self._db_status == 'settled'
+        is_settled = self.status == 'settled'
+        if was_settled == is_settled or self.transaction_date is None:
+            return
+
+        if is_settled:
+            MonthlySales.post(self)
+        else:
+            MonthlySales.unpost(self, self._db_amount)
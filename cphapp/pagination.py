@@ -0,0 +1,125 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import OrderedDict
+from binascii import Error as DecodeError
+from uuid import UUID
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, LimitOffsetPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    """
+    Pagination keyed on (transaction_date, id), newest first. Pages are
+    fetched with an indexed range condition instead of an offset and no
+    count query is made, so every page costs the same.
+    """
+
+    cursor_query_param = 'cursor'
+    limit_query_param = 'limit'
+    max_limit = 1000
+    invalid_cursor_message = 'Invalid cursor'
+
+    def __init__(self, default_limit):
+        self.default_limit = default_limit
+
+    def get_limit(self, request):
+        try:
+            limit = int(request.query_params[self.limit_query_param])
+        except (KeyError, ValueError):
+            return self.default_limit
+        return max(1, min(limit, self.max_limit))
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            direction, date, pk = urlsafe_b64decode(
+                encoded.encode()).decode().split('|')
+            transaction_date = parse_datetime(date)
+            pk = str(UUID(pk))
+        except (DecodeError, UnicodeDecodeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+        if direction not in ('n', 'p') or transaction_date is None:
+            raise NotFound(self.invalid_cursor_message)
+        return direction, transaction_date, pk
+
+    def encode_cursor(self, direction, instance):
+        cursor = '|'.join((direction, instance.transaction_date.isoformat(),
+                           str(instance.pk)))
+        return replace_query_param(
+            self.base_url, self.cursor_query_param,
+            urlsafe_b64encode(cursor.encode()).decode())
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.base_url = request.build_absolute_uri()
+        limit = self.get_limit(request)
+        cursor = self.decode_cursor(request)
+
+        # Rows without a transaction_date have no position in the keyset
+        queryset = queryset.filter(transaction_date__isnull=False)
+        if cursor is None:
+            direction = 'n'
+            queryset = queryset.order_by('-transaction_date', '-id')
+        else:
+            direction, transaction_date, pk = cursor
+            if direction == 'n':
+                queryset = queryset.filter(
+                    Q(transaction_date__lt=transaction_date) |
+                    Q(transaction_date=transaction_date, id__lt=pk)
+                ).order_by('-transaction_date', '-id')
+            else:
+                queryset = queryset.filter(
+                    Q(transaction_date__gt=transaction_date) |
+                    Q(transaction_date=transaction_date, id__gt=pk)
+                ).order_by('transaction_date', 'id')
+
+        results = list(queryset[:limit + 1])
+        has_more = len(results) > limit
+        results = results[:limit]
+        if direction == 'p':
+            results.reverse()
+
+        self.next_link = self.previous_link = None
+        if results:
+            if direction == 'p' or has_more:
+                self.next_link = self.encode_cursor('n', results[-1])
+            if (direction == 'n' and cursor is not None) or has_more:
+                self.previous_link = self.encode_cursor('p', results[0])
+        elif direction == 'p':
+            # Nothing newer, go back to the first page
+            self.next_link = remove_query_param(
+                self.base_url, self.cursor_query_param)
+        return results
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.next_link),
+            ('previous', self.previous_link),
+            ('results', data)
+        ]))
+
+
+class TransactionPagination(LimitOffsetPagination):
+    """
+    Limit/offset pagination, unless the request has a ``cursor`` query
+    parameter (empty for the first page) which switches to
+    KeysetPagination.
+    """
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.keyset = None
+        if KeysetPagination.cursor_query_param in request.query_params:
+            self.keyset = KeysetPagination(self.default_limit)
+            self.display_page_controls = False
+            return self.keyset.paginate_queryset(queryset, request, view)
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        if self.keyset is not None:
+            return self.keyset.get_paginated_response(data)
+        return super().get_paginated_response(data)
@@ -0,0 +1,86 @@
+"""
+Registry of orders waiting for a final status: a sorted set in redis of
+transaction ids scored by the time each is due for its next check. Due
+orders are checked in bulk by tasks.poll_pending_orders.
+"""
+import logging
+import random
+from time import time
+
+from django.conf import settings
+
+from cphapp import redis
+
+logger = logging.getLogger(__name__)
+
+# IDs used in redis db 1
+TASK_ID_PENDING_ORDERS = 'task.id.pending.orders'
+# transaction id -> "<registered at> <number of checks>"
+PENDING_ORDERS_META = 'task.id.pending.orders.meta'
+
+
+def register(transaction_id):
+    now = time()
+    pipe = redis.pipeline()
+    pipe.zadd(TASK_ID_PENDING_ORDERS, {
+        transaction_id: now + settings.PENDING_ORDERS_BACKOFF[0]})
+    pipe.hset(PENDING_ORDERS_META, transaction_id, f'{now!r} 0')
+    pipe.execute()
+
+
+def due(limit):
+    """ Ids of the orders due for a check, with their registration time """
+
+    ids = [i.decode() for i in redis.zrangebyscore(
+        TASK_ID_PENDING_ORDERS, '-inf', time(), start=0, num=limit)]
+    if not ids:
+        return {}
+    meta = redis.hmget(PENDING_ORDERS_META, ids)
+    return {i: float(m.split()[0]) if m else time()
+            for i, m in zip(ids, meta)}
+
+
+def remove(transaction_ids):
+    if transaction_ids:
+        pipe = redis.pipeline()
+        pipe.zrem(TASK_ID_PENDING_ORDERS, *transaction_ids)
+        pipe.hdel(PENDING_ORDERS_META, *transaction_ids)
+        pipe.execute()
+
+
+def reschedule(transaction_ids):
+    """
+    Push the next check of each order back exponentially. Orders pending
+    for longer than PENDING_ORDERS_MAX_AGE are dropped, sync_order_db
+    picks up their final status.
+    """
+
+    if not transaction_ids:
+        return
+    now = time()
+    first, longest = settings.PENDING_ORDERS_BACKOFF
+    scores, meta, expired = {}, {}, []
+    for transaction_id, m in zip(transaction_ids, redis.hmget(
+            PENDING_ORDERS_META, transaction_ids)):
+        registered_at, checks = m.split() if m else (now, 0)
+        registered_at, checks = float(registered_at), int(checks) + 1
+        if now - registered_at > settings.PENDING_ORDERS_MAX_AGE:
+            expired.append(transaction_id)
+            continue
+        delay = min(first * 2 ** checks, longest)
+        scores[transaction_id] = now + random.uniform(delay / 2, delay)
+        meta[transaction_id] = f'{registered_at!r} {checks}'
+
+    if expired:
+        logger.warning('Orders %s still pending after %ds, no longer polled',
+                       expired, settings.PENDING_ORDERS_MAX_AGE)
+        remove(expired)
+    if scores:
+        pipe = redis.pipeline()
+        pipe.zadd(TASK_ID_PENDING_ORDERS, scores, xx=True)
+        pipe.hset(PENDING_ORDERS_META, mapping=meta)
+        pipe.execute()
+
+
+def count():
+    return redis.zcard(TASK_ID_PENDING_ORDERS)
@@ -0,0 +1,91 @@
+"""
+Token buckets in redis shared by every web and Celery worker, one per
+coins.ph endpoint family (COINSPH_RATE_LIMITS). Background calls leave
+COINSPH_RATE_LIMIT_RESERVE of each bucket to user-facing calls.
+"""
+import logging
+from time import sleep, time
+
+from django.conf import settings
+
+from cphapp import redis
+from cphapp.exceptions import RateLimitError
+
+logger = logging.getLogger(__name__)
+
+# IDs used in redis db 1
+RATE_LIMIT_BUCKET = 'ratelimit.{}'
+
+# Call priorities
+HIGH = 'high'  # user-facing, may empty the bucket
+LOW = 'low'  # background, stops at the reserve
+
+# Refill the bucket then take a token if more than ARGV[4] would be left.
+# Returns whether a token was taken and the seconds to wait otherwise.
+_ACQUIRE_SCRIPT = redis.register_script("""
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local reserve = tonumber(ARGV[4])
+local bucket = redis.call('hmget', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or capacity
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(now - ts, 0) * rate)
+local allowed = 0
+local wait = 0
+if tokens - reserve >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+else
+    wait = (1 + reserve - tokens) / rate
+end
+redis.call('hset', KEYS[1], 'tokens', tostring(tokens), 'ts', ARGV[3])
+redis.call('expire', KEYS[1], math.ceil(capacity / rate) + 60)
+return {allowed, tostring(wait)}
+""")
+
+
+def _config(family):
+    return settings.COINSPH_RATE_LIMITS[family]
+
+
+def acquire(family, priority=LOW, timeout=None):
+    """
+    Block until a call of the endpoint family is allowed. Raises
+    RateLimitError if it would take longer than timeout seconds.
+    """
+
+    config = _config(family)
+    reserve = 0 if priority == HIGH \
+        else config['capacity'] * settings.COINSPH_RATE_LIMIT_RESERVE
+    deadline = None if timeout is None else time() + timeout
+    while True:
+        allowed, wait = _ACQUIRE_SCRIPT(
+            keys=[RATE_LIMIT_BUCKET.format(family)],
+            args=[config['rate'], config['capacity'], repr(time()), reserve])
+        if allowed:
+            return
+        wait = float(wait)
+        if deadline is not None and time() + wait > deadline:
+            raise RateLimitError(family)
+        logger.debug('Rate limit of %s reached, waiting %.3fs', family, wait)
+        sleep(wait)
+
+
+def levels():
+    """ Current token level and capacity of every bucket """
+
+    result = {}
+    now = time()
+    for family, config in settings.COINSPH_RATE_LIMITS.items():
+        tokens, ts = redis.hmget(
+            RATE_LIMIT_BUCKET.format(family), 'tokens', 'ts')
+        if tokens is None:
+            tokens = config['capacity']
+        else:
+            tokens = min(config['capacity'], float(tokens) + max(
+                now - float(ts), 0) * config['rate'])
+        result[family] = {'tokens': round(tokens, 3),
+                          'capacity': config['capacity'],
+                          'rate': config['rate']}
+    return result
@@ -0,0 +1,150 @@
+"""
+Pooled keep-alive requests.Session shared by every coins.ph call of a
+process. cph.coinsph calls the requests module functions, install() points
+it at SessionRequests so those calls go through the session. The session
+is created lazily per process, a forked Celery child never reuses the
+connections of its parent.
+"""
+import logging
+import os
+import sys
+import threading
+from collections import Counter
+from urllib.parse import urlsplit, urlunsplit
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_state = {'pid': None, 'session': None, 'adapter': None}
+_metrics = Counter()
+
+
+def _record_response(response, *args, **kwargs):
+    _metrics['responses'] += 1
+    _metrics[f'status_{response.status_code // 100}xx'] += 1
+    retries = getattr(response.raw, 'retries', None)
+    if retries is not None and retries.history:
+        _metrics['retries'] += len(retries.history)
+
+
+def _create_session():
+    config = settings.COINSPH_HTTP
+    # Only requests that never reached coins.ph are retried here. Responses
+    # are retried by upstream._call so every attempt takes a rate limit
+    # token and is seen by the circuit breaker.
+    retry = Retry(
+        total=config['retries'], connect=config['retries'], read=0,
+        status=0, backoff_factor=config['backoff_factor'])
+    adapter = HTTPAdapter(pool_connections=config['pool_connections'],
+                          pool_maxsize=config['pool_maxsize'],
+                          max_retries=retry)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.hooks['response'].append(_record_response)
+    return session, adapter
+
+
+def get_session():
+    pid = os.getpid()
+    if _state['pid'] != pid:
+        with _lock:
+            if _state['pid'] != pid:
+                _state['session'], _state['adapter'] = _create_session()
+                _state['pid'] = pid
+                _metrics.clear()
+                logger.info('Created coins.ph HTTP session for process %d',
+                            pid)
+    return _state['session']
+
+
+def _reset_after_fork():
+    # The child gets its own session and lock on first use
+    global _lock
+    _lock = threading.Lock()
+    _state['pid'] = None
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+class SessionRequests:
+    """
+    Stand-in for the requests module: the HTTP verb functions use the
+    pooled session with the default timeouts, anything else is forwarded
+    to requests.
+    """
+
+    def __getattr__(self, name):
+        return getattr(requests, name)
+
+    def request(self, method, url, **kwargs):
+        config = settings.COINSPH_HTTP
+        kwargs.setdefault(
+            'timeout', (config['connect_timeout'], config['read_timeout']))
+        if config.get('base_url'):
+            # Local stand-in (see cphapp.standin), keep path and query
+            base_url = urlsplit(config['base_url'])
+            url = urlunsplit(urlsplit(url)._replace(
+                scheme=base_url.scheme, netloc=base_url.netloc))
+        _metrics['requests'] += 1
+        try:
+            return get_session().request(method, url, **kwargs)
+        except requests.RequestException:
+            _metrics['errors'] += 1
+            raise
+
+    def get(self, url, params=None, **kwargs):
+        return self.request('GET', url, params=params, **kwargs)
+
+    def options(self, url, **kwargs):
+        return self.request('OPTIONS', url, **kwargs)
+
+    def head(self, url, **kwargs):
+        kwargs.setdefault('allow_redirects', False)
+        return self.request('HEAD', url, **kwargs)
+
+    def post(self, url, data=None, json=None, **kwargs):
+        return self.request('POST', url, data=data, json=json, **kwargs)
+
+    def put(self, url, data=None, **kwargs):
+        return self.request('PUT', url, data=data, **kwargs)
+
+    def patch(self, url, data=None, **kwargs):
+        return self.request('PATCH', url, data=data, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request('DELETE', url, **kwargs)
+
+
+def install(package='cph'):
+    """ Point every module of package that uses requests to the session """
+
+    session_requests = SessionRequests()
+    for name, module in list(sys.modules.items()):
+        if (name == package or name.startswith(f'{package}.')) \
+                and getattr(module, 'requests', None) is requests:
+            module.requests = session_requests
+            logger.debug('%s now uses the pooled HTTP session', name)
+
+
+def metrics():
+    """ Request counters and connection pools of the current process """
+
+    pools = []
+    adapter = _state['adapter'] if _state['pid'] == os.getpid() else None
+    if adapter is not None:
+        for key in adapter.poolmanager.pools.keys():
+            pool = adapter.poolmanager.pools[key]
+            pools.append({
+                'host': f'{pool.scheme}://{pool.host}:{pool.port}',
+                'connections': pool.num_connections,
+                'requests': pool.num_requests,
+                'idle': pool.pool.qsize() if pool.pool else 0,
+                'maxsize': pool.pool.maxsize if pool.pool else 0})
+    return {'pid': os.getpid(), 'counters': dict(_metrics), 'pools': pools}
@@ -1,24 +1,21 @@
 import logging
+from django.conf import settings
 from django.db.models.signals import post_save
 from django.dispatch import receiver
 from cphapp.models import LoadTransaction
-from cphapp.tasks import update_payment_data as upd
-
-from cphapp.test_assets import defines
+from cphapp.tasks import payment_update_chain
 
 logger = logging.getLogger(__name__)
 
 
 @receiver(post_save, sender=LoadTransaction)
 def update_payment_data(sender, instance, created, **kwargs):
-    """ Purpose is to get balance and posted_amount value """
+    """
+    Get balance and posted_amount right away when PAYMENT_DATA_EAGER is
+    set, for tests that check them after the save. Otherwise they come
+    through the outbox event written by LoadTransaction.save().
+    """
 
-    if instance.status in ['settled', 'refunded', 'released'] \
-            and instance.balance is None:
+    if settings.PAYMENT_DATA_EAGER and instance.awaits_payment_data:
         logger.info('Fetch payment data for transaction %s', instance.order_id)
-        # upd.apply(kwargs={'order_id': instance.order_id})
-
-        if instance.order_id in defines.TEST_ORDER_IDS:
-            upd.apply(kwargs={'order_id': instance.order_id})
-        else:
-            upd.apply_async(kwargs={'order_id': instance.order_id})
+        payment_update_chain(instance.order_id).apply()
@@ -0,0 +1,292 @@
+"""
+Local stand-in for the coins.ph endpoints used by this app, for load
+testing without the network. Serves synthetic orders, crypto-payments and
+payout-outlets and accepts new orders, with optional latency, 429/5xx
+faults and pagination edge cases. Run it with the runcoinsphstandin
+command and point the client at it with COINSPH_BASE_URL.
+
+Endpoints are told apart by keywords in the request path ('crypto-payments',
+'payout-outlets', 'order') so the stand-in does not depend on the exact
+paths and API versions used by cph.coinsph.
+"""
+import json
+import logging
+import random
+import threading
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import sleep, time
+from urllib.parse import parse_qs, urlparse
+from uuid import uuid4
+
+logger = logging.getLogger(__name__)
+
+OUTLETS = [
+    {'id': 'load-globe', 'name': 'Globe', 'prefixes': [
+        '+63905', '+63906', '+63915', '+63916', '+63917', '+63926',
+        '+63927', '+63935', '+63936', '+63945', '+63955', '+63956',
+        '+63965', '+63966', '+63967', '+63975', '+63977', '+63995',
+        '+63996', '+63997']},
+    {'id': 'load-smart', 'name': 'Smart', 'prefixes': [
+        '+63908', '+63911', '+63913', '+63914', '+63918', '+63919',
+        '+63920', '+63921', '+63928', '+63929', '+63939', '+63947',
+        '+63949', '+63951', '+63961', '+63998', '+63999']},
+    {'id': 'load-sun', 'name': 'Sun', 'prefixes': [
+        '+63922', '+63923', '+63924', '+63925', '+63931', '+63932',
+        '+63933', '+63934', '+63940', '+63941', '+63942', '+63943',
+        '+63973', '+63974']},
+]
+
+AMOUNTS = [10, 15, 20, 30, 50, 100, 150, 300, 500]
+
+
+class StandIn:
+    """ Synthetic coins.ph data and fault injection settings """
+
+    def __init__(self, orders=10000, days=90, retailers=(), latency=0,
+                 jitter=0, error_rate=0, throttle_rate=0, max_limit=None,
+                 drift_rate=0, settle_after=5, expire_rate=0.05, seed=None):
+        self.random = random.Random(seed)
+        self.retailers = list(retailers)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.max_limit = max_limit
+        self.drift_rate = drift_rate
+        self.settle_after = settle_after
+        self.expire_rate = expire_rate
+        self.lock = threading.Lock()
+        self.stats = {'requests': 0, 'throttled': 0, 'errors': 0}
+
+        self.orders = []  # newest first
+        self.payments = []  # newest first
+        self.balance = 1e6
+        now = time()
+        for created_time in sorted(
+                (now - self.random.uniform(0, days * 86400)
+                 for _ in range(orders)), reverse=True):
+            self.orders.append(self._order(int(created_time), final=True))
+        for order in reversed(self.orders):
+            if order['delivery_status'] in ('settled', 'refunded'):
+                self._pay(order)
+
+    def _phone_number(self):
+        prefix = self.random.choice(
+            self.random.choice(OUTLETS)['prefixes'])
+        return f'{prefix}{self.random.randint(0, 9999999):07d}'
+
+    def _order(self, created_time, final=False, data=None):
+        data = data or {}
+        phone_number = data.get('phone_number_load') or self._phone_number()
+        outlet = data.get('payment_outlet') or next(
+            o['id'] for o in OUTLETS if phone_number[:6] in o['prefixes'])
+        order = {
+            'id': uuid4().hex,
+            'external_transaction_id': data.get(
+                'external_transaction_id') or uuid4().hex,
+            'transaction_type': 'sellorder',
+            'created_time': str(created_time),
+            'settles_at': created_time + self.settle_after,
+            'status': 'pending',
+            'delivery_status': 'pending',
+            'amount': str(data.get('amount') or self.random.choice(AMOUNTS)),
+            'currency': 'PHP',
+            'product_code': data.get('product_code', 'regular'),
+            'payment_outlet_id': outlet,
+            'phone_number_load': phone_number,
+            'confirmation_code': uuid4().hex[:12].upper(),
+            'user_id': 'standin',
+            'user_agent': {
+                'device': 'Other', 'platform': 'Other', 'browser': 'Other',
+                'device_hash': f'standin-{self.random.randint(0, 99)}',
+                'user_agent': 'standin'},
+        }
+        if data.get('reference'):
+            order['reference'] = data['reference']
+        elif self.retailers:
+            order['reference'] = {
+                'retailer': self.random.choice(self.retailers),
+                'retailer_email': ''}
+        if final:
+            self._finalize(order)
+        return order
+
+    def _finalize(self, order):
+        order['status'] = 'success'
+        order['delivery_status'] = 'expired' \
+            if self.random.random() < self.expire_rate else 'settled'
+
+    def _pay(self, order):
+        amount = float(order['amount'])
+        self.balance -= amount
+        self.payments.insert(0, {
+            'id': uuid4().hex,
+            'reference': {'order_id': order['id']},
+            'posted_amount': str(-amount),
+            'running_balance': str(round(self.balance, 2)),
+            'created_at': datetime.fromtimestamp(
+                int(order['created_time']), timezone.utc).isoformat(),
+        })
+
+    def _settle_due(self):
+        now = time()
+        for order in self.orders:
+            if order['delivery_status'] != 'pending':
+                # Orders are newest first, the pending ones are at the top
+                if int(order['created_time']) < now - self.settle_after:
+                    break
+                continue
+            if order['settles_at'] <= now:
+                self._finalize(order)
+                if order['delivery_status'] == 'settled':
+                    self._pay(order)
+
+    def _drift(self):
+        # Orders created while a client pages through the list
+        if self.random.random() < self.drift_rate:
+            for _ in range(self.random.randint(1, 5)):
+                self.orders.insert(0, self._order(int(time()), final=True))
+
+    def _limit(self, limit):
+        # Server side cap, clients get short pages
+        return min(limit, self.max_limit) if self.max_limit else limit
+
+    def _page(self, items, params, key):
+        limit = self._limit(int(params.get('limit', 10)))
+        offset = int(params.get('offset', 0))
+        return {key: items[offset:offset + limit], 'meta': {'pagination': {
+            'total': len(items), 'limit': limit, 'offset': offset}}}
+
+    def list_orders(self, path, params):
+        with self.lock:
+            self._settle_due()
+            self._drift()
+            order_type = 'buyorder' if 'buyorder' in path else params.get(
+                'order_type', 'sellorder')
+            orders = [o for o in self.orders
+                      if o['transaction_type'] == order_type]
+            if 'external_transaction_id' in params:
+                orders = [o for o in orders if o['external_transaction_id']
+                          == params['external_transaction_id']]
+            if 'status' in params:
+                orders = [o for o in orders
+                          if o['status'] == params['status']]
+            return 200, self._page(orders, params, 'orders')
+
+    def create_order(self, data):
+        errors = [f'{field} is required' for field in (
+            'amount', 'phone_number_load', 'external_transaction_id')
+            if not data.get(field)]
+        if errors:
+            return 400, {'success': False, 'status': 400, 'errors': errors}
+        with self.lock:
+            order = self._order(int(time()), data=data)
+            self.orders.insert(0, order)
+            return 201, {'success': True, 'order': order}
+
+    def list_payments(self, params):
+        with self.lock:
+            self._settle_due()
+            order_id = next((params[key] for key in (
+                'order_id', 'reference.order_id', 'reference')
+                if key in params), None)
+            payments = self.payments if order_id is None else [
+                p for p in self.payments
+                if p['reference']['order_id'] == order_id]
+            # Paged by page number, unlike orders
+            per_page = self._limit(int(params.get('per_page', 10)))
+            page = int(params.get('page', 1))
+            start = (page - 1) * per_page
+            return 200, {
+                'crypto-payments': payments[start:start + per_page],
+                'meta': {'total_count': len(payments), 'page': page,
+                         'per_page': per_page,
+                         'next_page': page + 1 if start + per_page
+                         < len(payments) else None}}
+
+    def list_outlets(self, params):
+        phone_number = next((v for v in params.values()
+                             if str(v).startswith('+63')), None)
+        outlets = [o for o in OUTLETS if phone_number is None
+                   or phone_number[:6] in o['prefixes']]
+        return 200, {'payout-outlets': [{
+            'id': o['id'], 'name': o['name'], 'outlet_category': 'load',
+            'logo_url': f'https://example.com/{o["id"]}.png',
+            'amount_limits': [
+                {'currency': 'PHP', 'minimum': 5, 'maximum': 1000}],
+            'denominations': AMOUNTS, 'products': [],
+            'custom_allowed': True} for o in outlets]}
+
+    def fault(self):
+        """ Injected delay and error response, if any, of a request """
+
+        with self.lock:
+            self.stats['requests'] += 1
+            delay = max(self.latency + self.random.uniform(
+                -self.jitter, self.jitter), 0)
+            roll = self.random.random()
+            if roll < self.throttle_rate:
+                self.stats['throttled'] += 1
+                return delay, 429
+            if roll < self.throttle_rate + self.error_rate:
+                self.stats['errors'] += 1
+                return delay, self.random.choice((500, 502, 503))
+            return delay, None
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    standin = None  # set by make_server()
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+    def _respond(self, status, data, headers=None):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _handle(self, method):
+        delay, error = self.standin.fault()
+        sleep(delay)
+        if error == 429:
+            return self._respond(429, {'detail': 'Too many requests'},
+                                 {'Retry-After': '1'})
+        if error is not None:
+            return self._respond(error, {'status': error})
+
+        url = urlparse(self.path)
+        params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        if 'crypto-payments' in url.path and method == 'GET':
+            status, data = self.standin.list_payments(params)
+        elif 'payout-outlets' in url.path and method == 'GET':
+            status, data = self.standin.list_outlets(params)
+        elif 'order' in url.path and method == 'GET':
+            status, data = self.standin.list_orders(url.path, params)
+        elif 'order' in url.path and method == 'POST':
+            length = int(self.headers.get('Content-Length') or 0)
+            body = self.rfile.read(length).decode()
+            if 'json' in (self.headers.get('Content-Type') or ''):
+                data = json.loads(body or '{}')
+            else:
+                data = {k: v[-1] for k, v in parse_qs(body).items()}
+            status, data = self.standin.create_order(data)
+        else:
+            status, data = 404, {'detail': f'Unknown endpoint {url.path}'}
+        self._respond(status, data)
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+
+def make_server(standin, host='127.0.0.1', port=8900):
+    handler = type('Handler', (StandInHandler,), {'standin': standin})
+    return ThreadingHTTPServer((host, port), handler)
@@ -1,87 +1,152 @@
 from __future__ import absolute_import, unicode_literals
-import json
 import logging
-from time import sleep as delay
+import random
+from time import monotonic, sleep as delay
 from requests.exceptions import ConnectionError
 
+from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.db import transaction as db_transaction
+from django.utils.timezone import now
 from rest_framework import status
 
-from cphapp.models import LoadTransaction
+from cphapp.models import LoadTransaction, OutboxEvent
 from cphapp.api.serializers import LoadTransactionSerializer
-from cphapp import redis
-from cph.coinsph import fetch_crypto_payment, fetch_orders
+from cphapp import circuitbreaker, pending, redis, upstream
+from cphapp.locks import single_instance
+from cphapp.upstream import fetch_crypto_payment
 
-from celery import shared_task
+from celery import chain, chord, shared_task
+from celery.exceptions import Ignore
 from celery.result import AsyncResult
 from celery.app.task import Task
 from django_celery_beat.models import PeriodicTask
 
 from cphapp import utility
 from cphapp import exceptions
-from cphapp.test_assets import defines, json_file_path
 
 from fcm.tasks import send_confirmation
 
 logger = logging.getLogger(__name__)
 
 # IDs used in redis db 1
-TASK_ID_ONGOING_SYNC = 'task.id.ongoing.sync'
-TASK_ID_PENDING_ORDERS = 'task.id.pending.orders'
+SYNC_ORDER_DB_LOCK = 'task.lock.sync.order.db'
+BACKFILL_LOCK = 'task.lock.backfill.{order_type}'
+BACKFILL_SHARD_LOCK = 'task.lock.backfill.{order_type}.{offset}'
+# Result of a shard already being backfilled by another worker
+BACKFILL_SHARD_SKIPPED = 'skipped'
+POLL_PENDING_ORDERS_LOCK = 'task.lock.poll.pending.orders'
+OUTBOX_DISPATCH_STATS = 'task.outbox.dispatch.stats'
 
-USER_MODEL = get_user_model()
+# Outbox events handled per DB transaction by dispatch_outbox
+OUTBOX_BATCH_SIZE = 500
 
+FINAL_ORDER_STATUSES = ('settled', 'refunded', 'expired')
 
-class UpdateOrderDataTask(Task):
+# Priority of the work a retailer is waiting for, 0 is the highest with
+# redis (see CELERY_BROKER_TRANSPORT_OPTIONS)
+USER_PRIORITY = 0
 
-    max_retries = None
-    autoretry_for = (exceptions.OrderStatusError,)
-    retry_backoff = 1
-    retry_backoff_max = 6 * 60  # 6 mins
-    retry_jitter = True
+USER_MODEL = get_user_model()
 
-    def on_success(self, retval, task_id, args, kwargs):
-        AsyncResult(id=task_id).forget()
-
-        order_status = retval.get('delivery_status')
-        if order_status == 'expired':
-            obj = LoadTransaction.objects.get(id=kwargs.get('id'))
-            obj.status = order_status
-            obj.posted_amount = 0
-            obj.save()
-            send_confirmation.apply_async(kwargs={'order_id': obj.order_id})
-            AsyncResult(task_id).forget()
-        else:
-            update_payment_data.apply(
-                kwargs={'order_id': retval.get('id'),
-                        'order_status': order_status,
-                        'notify': True})
-
-
-@shared_task(bind=True, base=UpdateOrderDataTask)
-def update_order_data(self, id):
-    if id in defines.TEST_ORDER_IDS:
-        logger.info('update_order_data in TEST mode, using %s',
-                    json_file_path.GET_REQUEST_RESP_JSON)
-        with open(json_file_path.GET_REQUEST_RESP_JSON, 'r') as f:
-            resp = json.load(f)
-            order = resp.get('orders')[0]
-    else:
-        logger.info('update_order_data in PROD mode, fetch new data')
-        resp = fetch_orders(order_type='sellorder', external_transaction_id=id)
-        order = resp.json().get('orders')[0]
+
+class CircuitBreakerTask(Task):
+    """
+    Parks the task while the coins.ph circuit of circuit_family is open:
+    it is sent again once the circuit may be probed, without using up its
+    retries.
+    """
+
+    circuit_family = None
+
+    def __call__(self, *args, **kwargs):
+        if self.circuit_family is not None:
+            wait = circuitbreaker.retry_after(self.circuit_family)
+            if wait:
+                self.park(wait)
+        return super().__call__(*args, **kwargs)
+
+    def retry(self, *args, exc=None, **kwargs):
+        if isinstance(exc, exceptions.CircuitOpenError):
+            self.park(exc.retry_after)
+        return super().retry(*args, exc=exc, **kwargs)
+
+    def park(self, wait, args=None, kwargs=None):
+        # Spread the parked tasks so they do not all hit the probe at once
+        countdown = wait + random.uniform(
+            0, settings.COINSPH_CIRCUIT_BREAKER['open_seconds'])
+        logger.info('coins.ph %s circuit is open, parking task %s for %ds',
+                    self.circuit_family, self.request.id, countdown)
+        # Sent like a retry would be, keeping the rest of its chain
+        self.signature_from_request(
+            args=self.request.args if args is None else args,
+            kwargs=self.request.kwargs if kwargs is None else kwargs,
+        ).apply_async(countdown=countdown)
+        raise Ignore()
+
+
+def finalize_order_data(transaction_id, order):
+    """
+    Apply the final status of an order and notify its retailer. Settled
+    and refunded orders go through payment_update_chain(), traced by their
+    transaction id.
+    """
 
     order_status = order.get('delivery_status')
-    if order_status not in ['settled', 'refunded', 'expired']:
-        e = exceptions.OrderStatusError(order_status, id)
-        logger.info(e.__str__())
-        raise e
-    logger.info('Order %s status finalized to %s.', id, order_status)
-    return order
+    logger.info('[%s] Finalizing order %s, status %s', transaction_id,
+                order.get('id'), order_status)
+    if order_status == 'expired':
+        obj = LoadTransaction.objects.get(id=transaction_id)
+        obj.status = order_status
+        obj.posted_amount = 0
+        obj.save()
+        send_confirmation.apply_async(kwargs={'order_id': obj.order_id},
+                                      priority=USER_PRIORITY)
+    else:
+        payment_update_chain(order.get('id'), order_status, notify=True,
+                             trace_id=str(transaction_id),
+                             priority=USER_PRIORITY).apply_async()
+
 
+@shared_task(ignore_result=True)
+def finalize_order(transaction_id, order):
+    finalize_order_data(transaction_id, order)
 
-class UpdatePaymentTask(Task):
 
+@shared_task(ignore_result=True)
+@single_instance(POLL_PENDING_ORDERS_LOCK)
+def poll_pending_orders():
+    """
+    Check every registered order due for a check at once and fan out the
+    finalized ones to finalize_order.
+    """
+
+    due = pending.due(settings.PENDING_ORDERS_POLL_LIMIT)
+    if not due:
+        return
+
+    try:
+        orders = utility.fetch_pending_orders(due)
+    except exceptions.ServiceTemporaryUnavailableError as e:
+        logger.info('Pending orders not polled: %s', e)
+        return
+
+    finalized = [i for i, order in orders.items()
+                 if order.get('delivery_status') in FINAL_ORDER_STATUSES]
+    for transaction_id in finalized:
+        finalize_order.apply_async(
+            kwargs={'transaction_id': transaction_id,
+                    'order': orders[transaction_id]},
+            priority=USER_PRIORITY)
+    pending.remove(finalized)
+    pending.reschedule([i for i in due if i not in finalized])
+    logger.info('%d of %d due pending orders finalized',
+                len(finalized), len(due))
+
+
+class UpdatePaymentTask(CircuitBreakerTask):
+
+    circuit_family = upstream.CRYPTO_PAYMENTS
     max_retries = None
     autoretry_for = (Exception,)
     retry_backoff = True
@@ -89,35 +154,14 @@ class UpdatePaymentTask(Task):
     retry_jitter = True
 
     def on_success(self, retval, task_id, args, kwargs):
-        order_id = kwargs.get('order_id')
-        logger.info(order_id)
-        try:
-            obj = LoadTransaction.objects.get(order_id=kwargs.get('order_id'))
-        except LoadTransaction.MultipleObjectsReturned as e:
-            logger.error(order_id)
-            raise e
-
-        order_status = kwargs.get('order_status')
-        if order_status is not None:
-            retval.update({'status': order_status})
-
-        s = LoadTransactionSerializer(obj, data=retval, partial=True)
-        if not s.is_valid():
-            logger.critical(s.errors)
-        obj = s.update(obj, s.validated_data)
-
-        if kwargs.get('notify'):
-            send_confirmation.apply_async(kwargs={'order_id': order_id})
-
-        # Clear result from result backend
-        logger.info('Clearing task %s result from result backend.',
-                    self.request.id)
+        # The payment is passed on to the next step of the chain, clear
+        # it from the result backend
         AsyncResult(task_id).forget()
-        logger.info('Task %s succeeded', self.request.id)
 
 
-@shared_task(bind=True, base=UpdatePaymentTask)
-def update_payment_data(self, order_id, order_status=None, notify=False):
+def fetch_payment_data(order_id):
+    """ Fetch posted_amount and balance of an order from its payment """
+
     try:
         response = fetch_crypto_payment(order_id)
     except ConnectionError as e:
@@ -147,20 +191,151 @@ def update_payment_data(self, order_id, order_status=None, notify=False):
     }
 
 
-@shared_task(ignore_result=True)
-def sync_order_db():
+def apply_payment_data(order_id, payment, order_status=None):
     try:
-        ongoing_sync = redis.get(TASK_ID_ONGOING_SYNC).decode()
-        logger.info('ONGOING_SYNC: %s', ongoing_sync)
-        if ongoing_sync == 'TRUE':
-            logger.info("There's an ongoing sync. Retry later.")
-            return
-    except AttributeError:
-        redis.set(TASK_ID_ONGOING_SYNC, 'FALSE')
-        return
+        obj = LoadTransaction.objects.get(order_id=order_id)
+    except LoadTransaction.MultipleObjectsReturned as e:
+        logger.error(order_id)
+        raise e
+
+    if order_status is not None:
+        payment.update({'status': order_status})
+
+    s = LoadTransactionSerializer(obj, data=payment, partial=True)
+    if not s.is_valid():
+        logger.critical(s.errors)
+    return s.update(obj, s.validated_data)
 
+
+@shared_task(bind=True, base=UpdatePaymentTask)
+def fetch_payment(self, order_id, trace_id=None):
+    logger.info('[%s] Fetching payment data of order %s', trace_id,
+                order_id)
+    return fetch_payment_data(order_id)
+
+
+@shared_task(ignore_result=True)
+def apply_payment(payment, order_id, order_status=None, trace_id=None):
+    logger.info('[%s] Applying payment data of order %s', trace_id,
+                order_id)
+    apply_payment_data(order_id, payment, order_status)
+
+
+def payment_update_chain(order_id, order_status=None, notify=False,
+                         trace_id=None, priority=None):
+    """
+    fetch_payment -> apply_payment [-> send_confirmation], each step a
+    task of its own. trace_id (the order id by default) is logged by
+    every step.
+    """
+
+    trace_id = trace_id or order_id
+    steps = [
+        fetch_payment.s(order_id=order_id, trace_id=trace_id),
+        apply_payment.s(order_id=order_id, order_status=order_status,
+                        trace_id=trace_id)]
+    if notify:
+        steps.append(send_confirmation.si(order_id=order_id))
+    if priority is not None:
+        steps = [step.set(priority=priority) for step in steps]
+    return chain(*steps)
+
+
+@shared_task(ignore_result=True)
+def update_payment_data(order_id, order_status=None, notify=False):
+    payment_update_chain(order_id, order_status, notify).apply_async()
+
+
+PAYMENTS_DATA_MAX_ATTEMPTS = 5
+
+
+@shared_task(bind=True, base=CircuitBreakerTask, ignore_result=True,
+             circuit_family=upstream.CRYPTO_PAYMENTS)
+def update_payments_data(self, order_ids, attempt=1):
+    """
+    Fetch and apply payment data of a batch of orders: matched in bulk
+    against the newest crypto-payments first, the rest one by one.
+    """
+
+    if attempt == 1:
+        try:
+            order_ids = utility.reconcile_payments(order_ids)
+        except exceptions.CircuitOpenError as e:
+            self.park(e.retry_after)
+        except upstream.ERRORS:
+            logger.exception('Bulk payment data update failed, fetching '
+                             'them one by one')
+
+    failed = []
+    for i, order_id in enumerate(order_ids):
+        try:
+            apply_payment_data(order_id, fetch_payment_data(order_id))
+        except exceptions.CircuitOpenError as e:
+            # Park the rest of the batch, this attempt does not count
+            self.park(e.retry_after, args=(), kwargs={
+                'order_ids': failed + order_ids[i:], 'attempt': attempt})
+        except Exception:
+            failed.append(order_id)
+
+    logger.info('Payment data updated for %d of %d orders',
+                len(order_ids) - len(failed), len(order_ids))
+    if failed and attempt < PAYMENTS_DATA_MAX_ATTEMPTS:
+        # Retry the failed ones only
+        self.apply_async(kwargs={'order_ids': failed, 'attempt': attempt + 1},
+                         countdown=60 * attempt)
+    elif failed:
+        logger.error('Giving up payment data update of orders %s', failed)
+
+
+@shared_task(ignore_result=True)
+def dispatch_outbox(batch_size=OUTBOX_BATCH_SIZE):
+    """
+    Drain the outbox in batches. The payment data events of a batch are
+    collapsed per order into a single update_payments_data task, sent
+    before the batch deletion commits so an event is never lost. Locked
+    rows are skipped, concurrent runs drain different batches. Returns
+    the number of events, the tasks sent, the events per second and the
+    age of the oldest event.
+    """
+
+    started = monotonic()
+    events = tasks = 0
+    lag = 0
+    while True:
+        with db_transaction.atomic():
+            batch = list(OutboxEvent.objects.select_for_update(
+                skip_locked=True)[:batch_size])
+            if not batch:
+                break
+            lag = max(lag, (now() - batch[0].created_at).total_seconds())
+            order_ids = sorted({
+                event.order_id for event in batch
+                if event.event_type == OutboxEvent.PAYMENT_DATA})
+            if order_ids:
+                update_payments_data.apply_async(
+                    kwargs={'order_ids': order_ids})
+                tasks += 1
+            OutboxEvent.objects.filter(
+                id__in=[event.id for event in batch]).delete()
+        events += len(batch)
+        if len(batch) < batch_size:
+            break
+
+    elapsed = monotonic() - started
+    report = {'events': events, 'tasks': tasks,
+              'rate': round(events / elapsed, 1) if elapsed else 0,
+              'lag': round(lag, 3), 'finished_at': now().isoformat()}
+    redis.hset(OUTBOX_DISPATCH_STATS, mapping=report)
+    if events:
+        logger.info('Dispatched %(events)d outbox events as %(tasks)d tasks '
+                    'at %(rate).1f events/s, lag %(lag).3fs', report)
+    return report
+
+
+@shared_task(ignore_result=True)
+@single_instance(SYNC_ORDER_DB_LOCK)
+def sync_order_db():
     logger.info('Synchronizing DB')
-    redis.set(TASK_ID_ONGOING_SYNC, 'TRUE')
     try:
         utility.sync_order_db('sellorder')
         utility.sync_order_db('buyorder')
@@ -168,8 +343,45 @@ def sync_order_db():
         logger.info('Sync DONE')
     except Exception as e:
         logger.exception(e.__str__())
-    finally:
-        redis.set(TASK_ID_ONGOING_SYNC, 'FALSE')
+
+
+@shared_task(ignore_result=True)
+@single_instance(BACKFILL_LOCK)
+def backfill_orders(order_type, shard_size=2000, restart=False):
+    """ Fan out the order history import of order_type to shard tasks """
+
+    offsets = utility.start_backfill(order_type, shard_size, restart)
+    logger.info('Backfilling %d %s shards', len(offsets), order_type)
+    chord(backfill_order_shard.s(order_type, offset) for offset in offsets)(
+        finish_backfill.s(order_type))
+
+
+@shared_task(autoretry_for=(Exception,), retry_backoff=True, max_retries=5)
+@single_instance(BACKFILL_SHARD_LOCK, skipped=BACKFILL_SHARD_SKIPPED)
+def backfill_order_shard(order_type, offset):
+    months = utility.backfill_shard(order_type, offset)
+    return sorted(months)
+
+
+@shared_task(ignore_result=True, max_retries=None, retry_backoff=True,
+             autoretry_for=(exceptions.RewardsRecomputeBusyError,))
+def finish_backfill(results, order_type):
+    months = {tuple(month) for months in results
+              if months != BACKFILL_SHARD_SKIPPED for month in months}
+    if BACKFILL_SHARD_SKIPPED in results:
+        # Those orders may not be in yet, keep the high-water mark. The next
+        # backfill_orders resumes the shards not done.
+        logger.warning('%d %s backfill shards skipped, not finishing',
+                       results.count(BACKFILL_SHARD_SKIPPED), order_type)
+        utility.recompute_monthly_sales(months)
+        return
+    utility.finish_backfill(order_type, months)
+
+
+@shared_task(ignore_result=True)
+def sync_outlet_catalog():
+    logger.info('Synchronizing outlet catalog')
+    utility.sync_outlet_catalog()
 
 
 @shared_task(ignore_result=True)
@@ -177,7 +389,7 @@ def check_pending_orders():
     logger.info('Checking pending orders')
     periodic_sync_db = PeriodicTask.objects.get(name='sync_db')
     enabled = periodic_sync_db.enabled
-    pending_count = redis.llen(TASK_ID_PENDING_ORDERS)
+    pending_count = pending.count()
     logger.info('Pending order count %s. sync_order_db task %s',
                 pending_count, 'enabled' if enabled else 'disabled')
     if pending_count == 0 and enabled:
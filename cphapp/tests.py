@@ -1,11 +1,19 @@
 
 import json
 import os
+import threading
 import urllib
-from datetime import datetime
-
+from datetime import datetime, timedelta
+from time import sleep
+from types import SimpleNamespace
+from unittest import mock
+
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from django.db.models import Q
+from django.utils.timezone import localtime, make_aware, now
 from django.contrib.auth import get_user_model
 from django.conf import settings
 
@@ -13,9 +21,20 @@ from rest_framework.test import APITestCase
 from rest_framework import status
 from rest_framework.authtoken.models import Token
 
-from cphapp.models import LoadOutlet, LoadTransaction, Device
-from cphapp.utility import sync_order_db
+from cphapp.models import (
+    LoadOutlet, LoadTransaction, Device, MonthlySales, OutboxEvent,
+    OutletPrefix, get_reward_th)
+from cphapp import (
+    circuitbreaker, locks, pending, ratelimit, redis, session, upstream)
+from cphapp.exceptions import CircuitOpenError, RewardsRecomputeBusyError
+from cphapp.filters import TransactionsFilter
+from cphapp.standin import StandIn, make_server
+from cphapp.tasks import dispatch_outbox, poll_pending_orders
+from cphapp.utility import (
+    REWARDS_RECOMPUTE_LOCK, ingest_orders, recompute_monthly_sales,
+    sync_order_db)
 from cphapp.test_assets import defines, json_file_path
+from eload.celery import app as celery_app
 
 
 USER_MODEL = get_user_model()
@@ -83,6 +102,7 @@ class LoadOutletAPITestCase(CphAppAPITestCase):
         self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
 
 
+@override_settings(PAYMENT_DATA_EAGER=True)
 class LoadTransactionAPITestCase(CphAppAPITestCase):
 
     @classmethod
@@ -138,6 +158,7 @@ class LoadTransactionAPITestCase(CphAppAPITestCase):
         response = self.client.post(endpoint, post_data)
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
 
+    @override_settings(PENDING_ORDERS_BACKOFF=(0, 60))
     def test_create_transaction_user_initiated(self):
         """ Test sunny day scenario (transaction.status == 'settled') """
 
@@ -154,6 +175,14 @@ class LoadTransactionAPITestCase(CphAppAPITestCase):
         response = self.client.post(endpoint, posted_data)
         self.assertEqual(response.status_code, status.HTTP_201_CREATED)
 
+        # Finalized by the pending order poll, coins.ph answer from the assets
+        with open(json_file_path.GET_REQUEST_RESP_JSON, 'r') as f:
+            order = json.load(f).get('orders')[0]
+        with mock.patch.object(celery_app.conf, 'task_always_eager', True), \
+                mock.patch('cphapp.utility.fetch_pending_orders',
+                           return_value={posted_data['id']: order}):
+            poll_pending_orders.apply()
+
         obj = LoadTransaction.objects.get(id=posted_data.get('id'))
         self.assertEqual(obj.retailer.username, defines.USERA['username'])
         self.assertEqual(obj.id.hex, posted_data.get('id'))
@@ -179,9 +208,34 @@ class LoadTransactionAPITestCase(CphAppAPITestCase):
         resp = self.client.delete(endpoint)
         self.assertEqual(resp.status_code, status.HTTP_405_METHOD_NOT_ALLOWED)
 
+    def _fetch_asset_orders(self, order_type, limit=100, offset=0, **params):
+        # coins.ph order list from the asset pages, 10 orders each
+        if order_type == 'sellorder':
+            pages = json_file_path.SELL_ORDER_LIST
+            page1 = json_file_path.GET_REQUEST_SELL_ORDER_LIST_PAGE1
+        else:
+            pages = json_file_path.BUY_ORDER_LIST
+            page1 = json_file_path.GET_REQUEST_BUY_ORDER_LIST_PAGE1
+        with open(page1, 'r') as f:
+            total = json.load(f).get('meta').get('pagination').get('total')
+        orders = []
+        if offset < total:
+            with open(pages[offset // 10], 'r') as f:
+                orders = json.load(f).get('orders')
+        return mock.Mock(**{'json.return_value': {
+            'orders': orders, 'meta': {'pagination': {'total': total}}}})
+
+    def _sync_asset_orders(self, order_type):
+        with mock.patch('cphapp.upstream.fetch_orders',
+                        side_effect=self._fetch_asset_orders):
+            sync_order_db(order_type)
+        # Payment data is fetched by the tasks the outbox sends
+        with mock.patch.object(celery_app.conf, 'task_always_eager', True):
+            dispatch_outbox.apply()
+
     def test_create_sellorder_transaction_sync_initiated(self):
         # sellorders
-        sync_order_db('sellorder', test=True)
+        self._sync_asset_orders('sellorder')
         self.assertEqual(LoadTransaction.objects.filter(
             transaction_type='sellorder').count(),
             len(defines.TEST_SELL_ORDER_IDS))
@@ -205,7 +259,7 @@ class LoadTransactionAPITestCase(CphAppAPITestCase):
 
     def test_create_buyorder_transaction_sync_initiated(self):
         # buyorders
-        sync_order_db('buyorder', test=True)
+        self._sync_asset_orders('buyorder')
         self.assertEqual(LoadTransaction.objects.filter(
             transaction_type='buyorder').count(),
             len(defines.TEST_BUY_ORDER_IDS))
@@ -225,10 +279,486 @@ class LoadTransactionAPITestCase(CphAppAPITestCase):
 
         response = self.client.post(endpoint, posted_data)
         self.assertEqual(response.status_code, status.HTTP_201_CREATED)
-        reward_th = os.getenv('LOAD_NINJA_REWARD_TH',
-                              settings.LOADNINJA_REWARD_TH)
+        reward_th = get_reward_th()
 
         obj1 = LoadTransaction.objects.get(pk=defines.ORDER_TEST_ID)
         self.assertEqual(obj1.sold_this_month, 5)
         self.assertEqual(obj1.reward_amount, 5 *
                          reward_th.get('reward_factor'))
+
+
+class TransactionListQueryTestCase(CphAppAPITestCase):
+    # token auth, profile, page count and page select
+    QUERY_BUDGET = 4
+
+    def _create_transactions(self, count, start):
+        retailer = USER_MODEL.objects.get(
+            username=defines.USERA['username']).profile
+        device = retailer.devices.first()
+        for i in range(count):
+            LoadTransaction.objects.create(
+                amount=10, status='settled' if i % 2 else 'pending',
+                balance=0, retailer=retailer, device=device,
+                outlet_id='load-globe',
+                phone_number=defines.PHONE_NUMBER_GLOBE,
+                transaction_date=start + timedelta(hours=i))
+
+    def _count_list_queries(self):
+        with CaptureQueriesContext(connection) as context:
+            resp = self.client.get(reverse(self.list_endpoint))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        return len(context.captured_queries)
+
+    def test_list_query_budget(self):
+        self._login_user(defines.USERA['username'])
+        start = make_aware(datetime(2020, 7, 1))
+        self._create_transactions(2, start)
+        small_page = self._count_list_queries()
+        self._create_transactions(30, start + timedelta(days=2))
+        self.assertEqual(self._count_list_queries(), small_page)
+        self.assertLessEqual(small_page, self.QUERY_BUDGET)
+
+    def test_list_cursor_pagination(self):
+        self._login_user(defines.USERA['username'])
+        self._create_transactions(5, make_aware(datetime(2020, 7, 1)))
+        expected = list(LoadTransaction.objects.order_by(
+            '-transaction_date').values_list('id', flat=True))
+
+        endpoint = f'{reverse(self.list_endpoint)}?cursor=&limit=2'
+        ids = []
+        while endpoint:
+            with CaptureQueriesContext(connection) as context:
+                resp = self.client.get(endpoint)
+            self.assertFalse(any('COUNT(' in q['sql']
+                                 for q in context.captured_queries))
+            ids += [r['id'] for r in resp.data['results']]
+            endpoint = resp.data['next']
+        self.assertEqual(ids, [str(pk) for pk in expected])
+
+        # Walk back from the last page
+        resp = self.client.get(resp.data['previous'])
+        self.assertEqual([r['id'] for r in resp.data['results']],
+                         [str(pk) for pk in expected[2:4]])
+
+
+class MonthlySalesTestCase(TestCase):
+
+    def _create_transaction(self, amount, transaction_date, status='settled'):
+        # balance is set so post_save won't fetch payment data
+        return LoadTransaction.objects.create(
+            amount=amount, status=status, transaction_date=transaction_date,
+            balance=0)
+
+    def test_ledger_running_total(self):
+        day = make_aware(datetime(2020, 7, 10, 12))
+        tr1 = self._create_transaction(100, day)
+        tr2 = self._create_transaction(50, day + timedelta(hours=1))
+        self.assertEqual(tr1.month_to_date, 100)
+        self.assertEqual(tr2.month_to_date, 150)
+
+        # Late arrival shifts the transactions posted after it
+        tr0 = self._create_transaction(25, day - timedelta(hours=1))
+        self.assertEqual(tr0.month_to_date, 25)
+        tr2.refresh_from_db()
+        self.assertEqual(tr2.month_to_date, 175)
+
+        # Refund removes it from the month
+        tr1.status = 'refunded'
+        tr1.save()
+        tr2.refresh_from_db()
+        self.assertIsNone(tr1.month_to_date)
+        self.assertEqual(tr2.sold_this_month, 75)
+
+        ledger = MonthlySales.objects.get(year=2020, month=7)
+        self.assertEqual(ledger.amount, 75)
+        self.assertEqual(ledger.count, 2)
+        self.assertEqual(MonthlySales.rebuild(2020, 7, dry_run=True), ([], 0))
+
+    def test_late_arrival_rewards(self):
+        day = make_aware(datetime(2020, 7, 10, 12))
+        with mock.patch.dict(os.environ, {
+                'LOADNINJA_REWARD_TH': '{"limit": 120}'}):
+            self._create_transaction(100, day)
+            tr2 = self._create_transaction(50, day + timedelta(hours=1))
+            self.assertEqual(tr2.reward_amount, 5)
+
+            # Pushes the month past the limit before tr2
+            self._create_transaction(25, day - timedelta(hours=1))
+            tr2.refresh_from_db()
+            self.assertEqual(tr2.month_to_date, 175)
+            self.assertEqual(tr2.reward_amount, 2.5)
+
+    def test_recompute_busy(self):
+        # A recompute held elsewhere must not be dropped silently
+        with locks.hold(REWARDS_RECOMPUTE_LOCK), \
+                mock.patch('cphapp.utility.REWARDS_RECOMPUTE_WAIT', 0):
+            with self.assertRaises(RewardsRecomputeBusyError):
+                recompute_monthly_sales({(2020, 7)})
+
+    def test_post_new(self):
+        day = make_aware(datetime(2020, 7, 10, 12))
+        self._create_transaction(100, day)
+        # Inserted in bulk, as order sync does, balance None is incomplete
+        LoadTransaction.objects.bulk_create([
+            LoadTransaction(amount=50, status='settled', balance=0,
+                            transaction_date=day + timedelta(hours=2)),
+            LoadTransaction(amount=20, status='settled',
+                            transaction_date=day + timedelta(hours=1)),
+        ])
+        self.assertEqual(MonthlySales.post_new(since=day), set())
+        self.assertEqual(list(LoadTransaction.objects.order_by(
+            'transaction_date').values_list('month_to_date', flat=True)),
+            [100, 120, 170])
+        self.assertEqual(LoadTransaction.objects.get(
+            amount=20).reward_amount, 0)
+        self.assertGreater(LoadTransaction.objects.get(
+            amount=50).reward_amount, 0)
+        ledger = MonthlySales.objects.get(year=2020, month=7)
+        self.assertEqual((ledger.amount, ledger.count), (170, 3))
+
+        # A late one is left to rebuild()
+        LoadTransaction.objects.bulk_create([LoadTransaction(
+            amount=5, status='settled', balance=0, transaction_date=day)])
+        self.assertEqual(MonthlySales.post_new(), {(2020, 7)})
+        self.assertEqual(MonthlySales.rebuild(2020, 7)[0],
+                         [(2020, 7, 170, 175)])
+
+
+class IngestOrdersTestCase(TestCase):
+
+    def _order(self, order_id, **fields):
+        order = {
+            'id': order_id, 'created_time': '1594353600',
+            'status': 'success', 'delivery_status': 'expired',
+            'amount': '10', 'payment_outlet_id': 'load-globe',
+            'phone_number_load': '+639171234567',
+            'confirmation_code': 'ABC123', 'user_id': 'ingest'}
+        order.update(fields)
+        return order
+
+    def test_invalid_rows_skipped(self):
+        orders = [
+            self._order('ingest-valid'),
+            self._order('ingest-phone', phone_number_load='+6391712345678'),
+            self._order('ingest-code', confirmation_code='X' * 51),
+            self._order('ingest-outlet', payment_outlet_id='o' * 31),
+        ]
+        count, months = ingest_orders(orders, 'sellorder')
+        self.assertEqual(count, 1)
+        self.assertEqual(list(LoadTransaction.objects.values_list(
+            'order_id', flat=True)), ['ingest-valid'])
+
+        # Already ingested rows are skipped by bulk_create, not rejected
+        self.assertEqual(ingest_orders(
+            [self._order('ingest-valid')], 'sellorder')[0], 1)
+        self.assertEqual(LoadTransaction.objects.count(), 1)
+
+
+class OutletPrefixTestCase(TestCase):
+
+    def _create_outlet(self, outlet_id, prefixes):
+        return LoadOutlet.objects.create(
+            id=outlet_id, name=outlet_id, outlet_category='load',
+            logo_url='https://example.com/logo.png', amount_limits=[],
+            denominations=[], products=[], phone_number_prefixes=prefixes)
+
+    def test_prefix_index(self):
+        globe = self._create_outlet('load-globe', ['+63917', '+63917'])
+        self.assertEqual(globe.phone_number_prefixes, ['+63917'])
+        self.assertEqual(OutletPrefix.get_outlet('+639171234567'), globe)
+
+        globe.add_prefix('+63917')
+        globe.add_prefix('+63905')
+        globe.refresh_from_db()
+        self.assertEqual(globe.phone_number_prefixes, ['+63917', '+63905'])
+
+        # Moving a prefix to another outlet updates both
+        smart = self._create_outlet('load-smart', ['+63905'])
+        globe.refresh_from_db()
+        self.assertEqual(globe.phone_number_prefixes, ['+63917'])
+        self.assertEqual(OutletPrefix.get_outlet('+639051234567'), smart)
+
+        smart.delete()
+        self.assertIsNone(OutletPrefix.get_outlet('+639051234567'))
+
+
+class TransactionsFilterTestCase(TestCase):
+
+    def _filter(self, **params):
+        return TransactionsFilter(
+            params, queryset=LoadTransaction.objects.all()).qs
+
+    def test_date_filters(self):
+        today = localtime(now()).replace(hour=0, minute=0, second=1)
+        yesterday_end = today - timedelta(seconds=2)
+        for transaction_date in (today, yesterday_end):
+            LoadTransaction.objects.create(
+                amount=10, status='pending', transaction_date=transaction_date)
+
+        self.assertEqual(list(self._filter(date_range='today').values_list(
+            'transaction_date', flat=True)), [today])
+        self.assertEqual(list(self._filter(
+            date_range='yesterday').values_list(
+            'transaction_date', flat=True)), [yesterday_end])
+        self.assertEqual(self._filter(
+            transaction_date__year=today.year,
+            transaction_date__month=today.month,
+            transaction_date__day=today.day).count(), 1)
+        self.assertEqual(self._filter(
+            transaction_date__year=today.year,
+            transaction_date__month=2,
+            transaction_date__day=30).count(), 0)
+
+        # A day without its month is rejected, not ignored
+        filterset = TransactionsFilter({
+            'transaction_date__year': today.year,
+            'transaction_date__day': today.day},
+            queryset=LoadTransaction.objects.all())
+        self.assertFalse(filterset.is_valid())
+        self.assertIn('transaction_date__day', filterset.errors)
+
+
+@override_settings(COINSPH_CIRCUIT_BREAKER={
+    'failure_threshold': 2, 'failure_window': 60, 'open_seconds': 0.5,
+    'probe_timeout': 5})
+class CircuitBreakerTestCase(TestCase):
+    family = 'test'
+
+    def setUp(self):
+        self._reset()
+        self.addCleanup(self._reset)
+
+    def _reset(self):
+        redis.delete(circuitbreaker.CIRCUIT_STATE.format(self.family),
+                     circuitbreaker.CIRCUIT_PROBE.format(self.family))
+
+    def _state(self):
+        return circuitbreaker.states([self.family])[self.family]['state']
+
+    def test_transitions(self):
+        circuitbreaker.record(self.family, success=False)
+        circuitbreaker.allow(self.family)
+        circuitbreaker.record(self.family, success=False)
+        self.assertEqual(self._state(), circuitbreaker.OPEN)
+        with self.assertRaises(CircuitOpenError):
+            circuitbreaker.allow(self.family)
+
+        # A single probe once the circuit has been open long enough
+        sleep(0.5)
+        circuitbreaker.allow(self.family)
+        self.assertEqual(self._state(), circuitbreaker.HALF_OPEN)
+        with self.assertRaises(CircuitOpenError):
+            circuitbreaker.allow(self.family)
+        circuitbreaker.record(self.family, success=True)
+        self.assertEqual(self._state(), circuitbreaker.CLOSED)
+        circuitbreaker.allow(self.family)
+
+    @override_settings(
+        COINSPH_RATE_LIMITS={'test': {'rate': 0.01, 'capacity': 2}},
+        COINSPH_HTTP=dict(settings.COINSPH_HTTP, retries=1,
+                          backoff_factor=0))
+    def test_call_retries(self):
+        self.addCleanup(redis.delete,
+                        ratelimit.RATE_LIMIT_BUCKET.format(self.family))
+        calls = []
+
+        def call():
+            calls.append(1)
+            return SimpleNamespace(status_code=503, headers={})
+
+        # Each attempt takes a token and is recorded by the breaker
+        self.assertEqual(upstream._call(
+            self.family, ratelimit.HIGH, call).status_code, 503)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(self._state(), circuitbreaker.OPEN)
+        self.assertLess(ratelimit.levels()[self.family]['tokens'], 1)
+
+    @override_settings(
+        COINSPH_RATE_LIMITS={'test': {'rate': 0.01, 'capacity': 5}})
+    def test_call_probe_outcome(self):
+        self.addCleanup(redis.delete,
+                        ratelimit.RATE_LIMIT_BUCKET.format(self.family))
+        circuitbreaker.record(self.family, success=False)
+        circuitbreaker.record(self.family, success=False)
+        sleep(0.5)
+
+        # A throttled probe releases the probe for the next call
+        upstream._call(self.family, ratelimit.HIGH, lambda: SimpleNamespace(
+            status_code=429, headers={}), retries=0)
+        self.assertEqual(self._state(), circuitbreaker.HALF_OPEN)
+
+        # A client error of the probe re-opens the circuit
+        def call():
+            raise AssertionError('Unexpected response')
+
+        with self.assertRaises(AssertionError):
+            upstream._call(self.family, ratelimit.HIGH, call, retries=0)
+        self.assertEqual(self._state(), circuitbreaker.OPEN)
+
+
+@override_settings(PENDING_ORDERS_BACKOFF=(0, 60),
+                   PENDING_ORDERS_MAX_AGE=60)
+class PendingOrdersTestCase(TestCase):
+
+    def setUp(self):
+        self._reset()
+        self.addCleanup(self._reset)
+
+    def _reset(self):
+        redis.delete(pending.TASK_ID_PENDING_ORDERS,
+                     pending.PENDING_ORDERS_META)
+
+    def test_registry(self):
+        pending.register('order-a')
+        pending.register('order-b')
+        self.assertEqual(pending.count(), 2)
+        self.assertEqual(set(pending.due(limit=10)), {'order-a', 'order-b'})
+
+        # Checked orders are pushed back, finalized ones leave the registry
+        pending.reschedule(['order-a'])
+        pending.remove(['order-b'])
+        self.assertEqual(pending.count(), 1)
+        self.assertEqual(pending.due(limit=10), {})
+
+
+class LeaseTestCase(TestCase):
+    name = 'test.lock.{key}'
+
+    def setUp(self):
+        self.addCleanup(redis.delete, self.name.format(key='a'))
+
+    def test_single_instance(self):
+        calls = []
+
+        @locks.single_instance(self.name, ttl=300, skipped='skipped')
+        def run(key):
+            calls.append(key)
+            # Outlives the ttl, kept by the heartbeat
+            sleep(0.5)
+            return run(key)
+
+        self.assertEqual(run('a'), 'skipped')
+        self.assertEqual(calls, ['a'])
+        self.assertFalse(redis.exists(self.name.format(key='a')))
+
+
+class OutboxEventTestCase(TestCase):
+
+    def test_payment_data_event(self):
+        transaction = LoadTransaction.objects.create(
+            order_id='outbox-order', amount=10, status='pending',
+            transaction_date=now())
+        self.assertFalse(OutboxEvent.objects.exists())
+
+        # Written once, with the change into a payment data status
+        transaction.status = 'settled'
+        transaction.save()
+        transaction.save()
+        LoadTransaction.objects.get(pk=transaction.pk).save()
+        self.assertEqual(list(OutboxEvent.objects.values_list(
+            'event_type', 'order_id')),
+            [(OutboxEvent.PAYMENT_DATA, 'outbox-order')])
+
+        transaction.balance = 100
+        transaction.save()
+        self.assertEqual(OutboxEvent.objects.count(), 1)
+
+
+class StandInMixin:
+    """ Serves coins.ph calls of a test from a StandIn on a free port """
+
+    def _start_standin(self, **kwargs):
+        self.standin = StandIn(seed=1, **kwargs)
+        self.server = make_server(self.standin, port=0)
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        config = dict(settings.COINSPH_HTTP, base_url=(
+            'http://127.0.0.1:{}'.format(self.server.server_port)))
+        override = override_settings(COINSPH_HTTP=config)
+        override.enable()
+        self.addCleanup(override.disable)
+
+
+class StandInTestCase(StandInMixin, TestCase):
+
+    def setUp(self):
+        self._start_standin(orders=120, max_limit=50, settle_after=0)
+        self.requests = session.SessionRequests()
+
+    def test_orders(self):
+        # Sent to the stand-in instead of coins.ph, pages capped at 50
+        response = self.requests.get(
+            'https://coins.ph/api/v3/sellorder/',
+            params={'limit': 100, 'offset': 100}).json()
+        self.assertEqual(len(response['orders']), 20)
+        self.assertEqual(response['meta']['pagination']['total'], 120)
+
+        response = self.requests.post(
+            'https://coins.ph/api/v3/sellorder/', json={
+                'amount': 10, 'phone_number_load': '+639171234567',
+                'external_transaction_id': 'standin-order'})
+        self.assertEqual(response.status_code, 201)
+        order = self.requests.get(
+            'https://coins.ph/api/v3/sellorder/',
+            params={'external_transaction_id': 'standin-order'}
+        ).json()['orders'][0]
+        self.assertIn(order['delivery_status'], ('settled', 'expired'))
+        self.assertEqual(order['payment_outlet_id'], 'load-globe')
+
+    def test_faults(self):
+        self.standin.throttle_rate = 1
+        response = self.requests.get('https://coins.ph/api/v3/sellorder/')
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.headers['Retry-After'], '1')
+
+        self.standin.throttle_rate, self.standin.error_rate = 0, 1
+        response = self.requests.get(
+            'https://coins.ph/d/api/crypto-payments/')
+        self.assertGreaterEqual(response.status_code, 500)
+        self.assertEqual(self.standin.stats['requests'], 2)
+
+
+class StandInAPITestCase(StandInMixin, CphAppAPITestCase):
+
+    def setUp(self):
+        self._start_standin(orders=0, settle_after=60)
+        self._login_user(defines.USERA['username'])
+
+    def test_create_order(self):
+        # The outlet and the new order both come from the stand-in
+        phone_number = '+639171234567'
+        response = self.client.get(reverse(self.buy_product_endpoint),
+                                   {'phone_number': phone_number})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['id'], 'load-globe')
+
+        response = self.client.post(reverse(self.list_endpoint), {
+            'amount': 1, 'phone_number': phone_number,
+            'outlet_id': 'load-globe'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        response = self.client.post(reverse(self.list_endpoint), {
+            'amount': 10, 'phone_number': phone_number,
+            'outlet_id': 'load-globe'})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        order = response.data['order']
+        self.addCleanup(pending.remove, [order['external_transaction_id']])
+        transaction = LoadTransaction.objects.get(order_id=order['id'])
+        self.assertEqual(transaction.amount, 10)
+        self.assertEqual(transaction.retailer.username,
+                         defines.USERA['username'])
+
+
+class RewardThresholdTestCase(SimpleTestCase):
+
+    def test_environment_override(self):
+        with mock.patch.dict(os.environ, {
+                'LOADNINJA_REWARD_TH': '{"limit": 500}'}):
+            reward_th = get_reward_th()
+        self.assertEqual(reward_th['limit'], 500)
+        self.assertEqual(reward_th['reward_factor'],
+                         settings.LOADNINJA_REWARD_TH['reward_factor'])
+        self.assertEqual(LoadTransaction.get_reward_factor(600, reward_th),
+                         reward_th['reward_factor_onwards'])
@@ -0,0 +1,105 @@
+"""
+Every call to coins.ph goes through here rather than cph.coinsph so it
+is accounted for by the shared rate limiter and circuit breaker.
+"""
+import logging
+from time import sleep
+
+from cph import coinsph
+from django.conf import settings
+from requests.exceptions import RequestException
+
+from cphapp import circuitbreaker, ratelimit
+from cphapp.exceptions import RateLimitError, ServiceTemporaryUnavailableError
+
+# Endpoint families, see COINSPH_RATE_LIMITS
+ORDERS = 'orders'
+CRYPTO_PAYMENTS = 'crypto-payments'
+PAYOUT_OUTLETS = 'payout-outlets'
+NEW_ORDER = 'new-order'
+
+FAMILIES = (ORDERS, CRYPTO_PAYMENTS, PAYOUT_OUTLETS, NEW_ORDER)
+
+# Raised when coins.ph could not be reached or is not let through
+ERRORS = (RequestException, RateLimitError, ServiceTemporaryUnavailableError)
+
+logger = logging.getLogger(__name__)
+
+
+def _retry_delay(response, attempt):
+    config = settings.COINSPH_HTTP
+    delay = config['backoff_factor'] * 2 ** attempt
+    retry_after = response.headers.get('Retry-After', '')
+    if retry_after.isdigit():
+        delay = max(delay, int(retry_after))
+    return min(delay, config['max_retry_after'])
+
+
+def _call(family, priority, func, *args, timeout=None, retries=None,
+          **kwargs):
+    """
+    Call func once the rate limiter and circuit breaker let it through.
+    5xx responses are retried up to COINSPH_HTTP['retries'] times, every
+    attempt going through both again. 429 is returned to the caller.
+    """
+
+    if retries is None:
+        retries = settings.COINSPH_HTTP['retries']
+    for attempt in range(retries + 1):
+        # Wait for a token first, a probe must not sit in the rate limiter
+        ratelimit.acquire(family, priority, timeout=timeout)
+        probe = circuitbreaker.allow(family)
+        try:
+            response = func(*args, **kwargs)
+        except Exception:
+            # Connection errors and the client's own errors, e.g. the
+            # AssertionError cph.coinsph raises on an unexpected response
+            circuitbreaker.record(family, success=False)
+            raise
+        except BaseException:
+            # Interrupted, e.g. worker shutdown, no outcome to record
+            if probe:
+                circuitbreaker.release(family)
+            raise
+        if not hasattr(response, 'status_code'):
+            # Parsed data, the client raises on HTTP errors
+            circuitbreaker.record(family, success=True)
+            return response
+        if response.status_code == 429:
+            # Throttling says nothing about the health of the service
+            if probe:
+                circuitbreaker.release(family)
+            return response
+        circuitbreaker.record(family, success=response.status_code < 500)
+        if response.status_code < 500 or attempt == retries:
+            return response
+        logger.info('coins.ph %s call failed with %d, retrying', family,
+                    response.status_code)
+        sleep(_retry_delay(response, attempt))
+
+
+def fetch_orders(*args, priority=ratelimit.LOW, **kwargs):
+    return _call(ORDERS, priority, coinsph.fetch_orders, *args, **kwargs)
+
+
+def fetch_crypto_payment(*args, priority=ratelimit.LOW, **kwargs):
+    return _call(CRYPTO_PAYMENTS, priority, coinsph.fetch_crypto_payment,
+                 *args, **kwargs)
+
+
+def get_crypto_payments(page=1, per_page=100, priority=ratelimit.LOW):
+    """ A page of crypto-payments, newest first, paged by meta.next_page """
+    return _call(CRYPTO_PAYMENTS, priority, coinsph.get_crypto_payments,
+                 page=page, per_page=per_page)
+
+
+def fetch_outlet_data(*args, priority=ratelimit.LOW, **kwargs):
+    return _call(PAYOUT_OUTLETS, priority, coinsph.fetch_outlet_data,
+                 *args, **kwargs)
+
+
+def request_new_order(*args, timeout=None, **kwargs):
+    # Placed by a retailer waiting on the response, never wait long. Not
+    # idempotent, never retried.
+    return _call(NEW_ORDER, ratelimit.HIGH, coinsph.request_new_order,
+                 *args, timeout=timeout, retries=0, **kwargs)
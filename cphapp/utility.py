@@ -1,97 +1,519 @@
 import logging
-import json
+from datetime import datetime, timedelta, timezone
+from time import monotonic, sleep
 
 from requests.exceptions import ConnectionError
 
+from django.conf import settings
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from django.utils.timezone import localtime
+
 from rest_framework import status
 from rest_framework import serializers
-from rest_framework.response import Response
 
-from cphapp.models import LoadTransaction as Order, LoadOutlet
+from cphapp import redis
+from cphapp import ratelimit, upstream
+from cphapp.exceptions import RewardsRecomputeBusyError
+from cphapp.locks import Lease, hold
+from cphapp.models import (
+    LoadTransaction as Order, LoadOutlet, OutletPrefix, Device, MonthlySales,
+    OutboxEvent, SyncCheckpoint, PAYMENT_DATA_STATUSES, get_reward_th)
 from cphapp.api.serializers import (
-    LoadTransactionSerializer, LoadOutletSerializer)
-from cphapp.test_assets import json_file_path
+    LoadOutletSerializer, OrderIngestSerializer, UserAgentSerializer)
 
-from cph import coinsph
+from profiles.models import Profile as Retailer
 
 logger = logging.getLogger(__name__)
 
+# IDs used in redis db 1
+OUTLET_UNSUPPORTED_PREFIX = 'outlet.unsupported.{}'
+OUTLET_FETCH_LOCK = 'outlet.fetch.{}'
+OUTLET_CATALOG_SYNCED = 'outlet.catalog.synced'
 
-def fetch_orders(order_type, count, offset=0, test=False):
-    max_limit = 10 if test else 100
-    limit = count if count <= max_limit else max_limit
+BACKFILL_STATE = 'backfill.{}'
+BACKFILL_DONE_SHARDS = 'backfill.{}.done'
+REWARDS_RECOMPUTE_LOCK = 'lock.rewards.recompute'
 
-    if test:
-        if order_type == 'sellorder':
-            order_page_list = json_file_path.SELL_ORDER_LIST
-        else:
-            order_page_list = json_file_path.BUY_ORDER_LIST
-        with open(order_page_list[int(offset/max_limit)]) as f:
-            orders = json.load(f).get('orders')
-    else:
-        resp = coinsph.fetch_orders(
-            order_type, limit=limit, offset=offset, status='success')
-        orders = resp.json().get('orders')
+OUTLET_FETCH_POLL_INTERVAL = 0.05  # seconds
+# Seconds a reward recompute waits for the one running elsewhere
+REWARDS_RECOMPUTE_WAIT = 10 * 60
 
-    for order in orders:
-        yield order
-
-
-def sync_order_db(order_type, count=None, offset=0, test=False):
-    num_instance_in_db = Order.objects.filter(
-        transaction_type=order_type).count()
-    if count is None:
-        if test:
-            if order_type == 'sellorder':
-                page1 = json_file_path.GET_REQUEST_SELL_ORDER_LIST_PAGE1
-            else:
-                page1 = json_file_path.GET_REQUEST_BUY_ORDER_LIST_PAGE1
-            with open(page1, 'r') as f:
-                resp = Response(json.load(f), status=status.HTTP_200_OK)
-                resp = resp.data
-        else:
-            try:
-                resp = coinsph.fetch_orders(order_type, limit=1)
-                resp = resp.json()
-            except ConnectionError as e:
-                logger.exception('Unable to connect to server')
-                raise e
-
-        current_count = resp.get('meta').get('pagination').get('total')
-    else:
-        current_count = count
-    # Determine new number of entries by comparing the DB record count to the
-    # "total" field on the response meta
-    if current_count == num_instance_in_db:
-        return
+# Crypto-payments listed per call when reconciling payments
+PAYMENTS_PAGE_SIZE = 100
+# How much older than its transaction a crypto-payment may be listed
+PAYMENTS_SCAN_SLACK = timedelta(minutes=5)
+
+
+def fetch_order_page(order_type, offset=0):
+    """
+    Fetch a page of successful orders, newest first. Returns the orders and
+    the total number of orders upstream.
+    """
+
+    try:
+        resp = upstream.fetch_orders(
+            order_type, limit=100, offset=offset, status='success')
+    except ConnectionError as e:
+        logger.exception('Unable to connect to server')
+        raise e
+    resp = resp.json()
+    return (resp.get('orders'),
+            resp.get('meta').get('pagination').get('total'))
+
+
+# Orders listed per call when looking up pending orders
+PENDING_ORDERS_PAGE_SIZE = 100
+# Seconds an order may have been created before it was registered
+PENDING_ORDERS_SCAN_SLACK = 5 * 60
+
+
+def fetch_pending_orders(pending):
+    """
+    Look up sellorders by external_transaction_id with as few list calls as
+    possible. pending maps the ids to the time they were registered. The
+    newest orders are listed until every id is found or the listing gets
+    older than the oldest of them, the ones beyond the scanned pages are
+    fetched one by one. Returns the orders found by id.
+    """
+
+    found = {}
+    oldest = min(pending.values()) - PENDING_ORDERS_SCAN_SLACK
+    scanned_to = None
+    offset = 0
+    for _ in range(settings.PENDING_ORDERS_MAX_PAGES):
+        orders = upstream.fetch_orders(
+            'sellorder', limit=PENDING_ORDERS_PAGE_SIZE,
+            offset=offset).json().get('orders') or []
+        for order in orders:
+            if order.get('external_transaction_id') in pending:
+                found[order.get('external_transaction_id')] = order
+        if len(found) == len(pending) \
+                or len(orders) < PENDING_ORDERS_PAGE_SIZE \
+                or int(orders[-1].get('created_time')) < oldest:
+            return found
+        scanned_to = int(orders[-1].get('created_time'))
+        offset += len(orders)
+
+    for transaction_id, registered_at in pending.items():
+        if transaction_id not in found \
+                and registered_at < scanned_to + PENDING_ORDERS_SCAN_SLACK:
+            orders = upstream.fetch_orders(
+                order_type='sellorder',
+                external_transaction_id=transaction_id).json().get('orders')
+            if orders:
+                found[transaction_id] = orders[0]
+    return found
+
+
+class OrderBatchResolver:
+    """
+    Resolves the devices and retailers of a page of orders with a query
+    each, creating the missing devices in bulk. Used in place of
+    LoadTransactionSerializer by order_to_transactions_map().
+    """
+
+    def __init__(self, orders):
+        user_agents = [order.get('user_agent') for order in orders
+                       if order.get('user_agent')]
+        usernames = {order['reference'].get('retailer') for order in orders
+                     if order.get('reference')}
+
+        keys = {self._device_key(ua) for ua in user_agents}
+        hashes = {value for field, value in keys if field == 'device_hash'}
+        agents = {value for field, value in keys if field == 'user_agent'}
+        devices = Device.objects.filter(
+            Q(device_hash__in=hashes) | Q(user_agent__in=agents)
+        ).select_related('owner')
+        self.devices = {}
+        for device in devices:
+            self.devices.setdefault(('device_hash', device.device_hash),
+                                    device)
+            self.devices.setdefault(('user_agent', device.user_agent),
+                                    device)
 
-    diff_count = current_count - num_instance_in_db
-    logger.info('Fetch and sync %d new transactions', diff_count)
+        new_devices = {}
+        for ua in user_agents:
+            key = self._device_key(ua)
+            if key in self.devices or key in new_devices:
+                continue
+            serializer = UserAgentSerializer(data=ua)
+            if serializer.is_valid():
+                new_devices[key] = Device(**serializer.validated_data)
+        Device.objects.bulk_create(new_devices.values())
+        self.devices.update(new_devices)
 
-    orders = fetch_orders(order_type, diff_count, offset=offset, test=test)
+        self.retailers = {
+            retailer.user.username: retailer
+            for retailer in Retailer.objects.filter(
+                user__username__in=usernames).select_related('user')}
+        self.retailers_by_id = {
+            retailer.id: retailer for retailer in self.retailers.values()}
+        self.retailers_by_id.update({
+            device.owner.id: device.owner for device in self.devices.values()
+            if device.owner is not None})
 
+    @staticmethod
+    def _device_key(ua_dict):
+        field = 'device_hash' if ua_dict.get('device_hash') else 'user_agent'
+        return field, ua_dict.get(field)
+
+    def get_user_agent(self, ua_dict):
+        try:
+            return self.devices[self._device_key(ua_dict)]
+        except KeyError:
+            raise ValueError(f'Invalid user_agent {ua_dict}')
+
+    def get_retailer(self, data):
+        if data.get('reference'):
+            retailer = self.retailers.get(
+                data.get('reference').get('retailer'))
+            if retailer is not None:
+                return retailer.id
+
+        if data.get('user_agent') is None:
+            return None
+        device = self.devices.get(
+            ('device_hash', data.get('user_agent').get('device_hash')))
+        if device is None or device.owner is None:
+            return None
+        return device.owner.id
+
+
+def ingest_orders(orders, order_type):
+    """
+    Insert a page of coins.ph orders at once, skipping the ones already in
+    the DB. Payment data of the incomplete ones is queued to the outbox.
+    Returns the number of valid orders and the (year, month) of the
+    settled ones. Their MonthlySales and rewards are left to
+    post_monthly_sales() or, for history, recompute_monthly_sales().
+    """
+
+    resolver = OrderBatchResolver(orders)
+    transactions = []
+    months = set()
     for order in orders:
         if order.get('reference'):
             order['transaction_id'] = order.get('external_transaction_id')
         order['transaction_type'] = order_type
-        serializer = LoadTransactionSerializer(data=order)
-        if not serializer.is_valid():
+        order['product_code'] = order.get('product_code') or 'regular'
+        try:
+            serializer = OrderIngestSerializer(data=order, resolver=resolver)
+            valid = serializer.is_valid()
+        except (TypeError, ValueError) as e:
+            logger.error('Error while mapping %s with ID %s. %s.',
+                         order_type, order.get('id'), e)
+            continue
+        if not valid:
             logger.error('Error while serializing %s with ID %s. %s.',
-                         order_type, order.get('id'),
-                         serializer.error_messages)
-            logger.error(serializer.errors)
-            current_count -= 1
-        else:
-            serializer.create(serializer.validated_data)
-        offset += 1
+                         order_type, order.get('id'), serializer.errors)
+            continue
+
+        mapped = serializer.initial_data
+        transaction = Order(
+            id=mapped['id'],
+            retailer=resolver.retailers_by_id.get(mapped.get('retailer')),
+            device_id=mapped['device'],
+            **serializer.validated_data)
+        transaction.update_top_up_amount()
+        if transaction.status == 'settled':
+            transaction_date = localtime(transaction.transaction_date)
+            months.add((transaction_date.year, transaction_date.month))
+        transactions.append(transaction)
+
+    Order.objects.bulk_create(
+        transactions, batch_size=500, ignore_conflicts=True)
+
+    incomplete = list(Order.objects.filter(
+        order_id__in=[t.order_id for t in transactions],
+        status__in=PAYMENT_DATA_STATUSES,
+        balance=None).values_list('order_id', flat=True))
+    if incomplete:
+        logger.info('Fetch payment data for %d transactions', len(incomplete))
+        OutboxEvent.objects.bulk_create(
+            OutboxEvent(event_type=OutboxEvent.PAYMENT_DATA,
+                        order_id=order_id) for order_id in incomplete)
+
+    return len(transactions), months
+
+
+def reconcile_payments(order_ids):
+    """
+    Fill posted_amount and balance of the incomplete transactions among
+    order_ids from a single scan of the newest crypto-payments, matched on
+    their reference order id, and write them in bulk along with the reward
+    of the ones already posted to MonthlySales. Returns the order ids left
+    unmatched.
+    """
+
+    transactions = {t.order_id: t for t in Order.objects.filter(
+        order_id__in=order_ids, status__in=PAYMENT_DATA_STATUSES,
+        balance=None).only('id', 'order_id', 'status', 'transaction_type',
+                           'amount', 'transaction_date', 'posted_amount',
+                           'balance', 'reward_amount', 'month_to_date')}
+    if not transactions:
+        return []
+
+    oldest = min(t.transaction_date for t in transactions.values()) \
+        - PAYMENTS_SCAN_SLACK
+    payments = {}
+    page = 1
+    calls = 0
+    while page is not None \
+            and calls < settings.PAYMENTS_RECONCILE_MAX_PAGES:
+        response = upstream.get_crypto_payments(
+            page=page, per_page=PAYMENTS_PAGE_SIZE)
+        calls += 1
+        crypto_payments = response.get('crypto-payments') or []
+        for payment in crypto_payments:
+            order_id = (payment.get('reference') or {}).get('order_id')
+            if order_id in transactions:
+                payments[order_id] = payment
+        if len(payments) == len(transactions) or not crypto_payments \
+                or parse_datetime(
+                    crypto_payments[-1].get('created_at')) < oldest:
+            break
+        page = (response.get('meta') or {}).get('next_page')
+
+    reward_th = get_reward_th()
+    for order_id, payment in payments.items():
+        transaction = transactions[order_id]
+        for field, key in (('posted_amount', 'posted_amount'),
+                           ('balance', 'running_balance')):
+            value = payment.get(key)
+            setattr(transaction, field, None if value is None else float(
+                value))
+        if transaction.earns_reward and transaction.month_to_date is not None:
+            # Not yet posted ones get their reward from post_monthly_sales()
+            transaction.reward_amount = transaction.amount \
+                * Order.get_reward_factor(
+                    transaction.month_to_date - transaction.amount,
+                    reward_th)
+    Order.objects.bulk_update(
+        [transactions[order_id] for order_id in payments],
+        ['posted_amount', 'balance', 'reward_amount'], batch_size=500)
+
+    logger.info('Payment data of %d of %d transactions reconciled in %d '
+                'calls', len(payments), len(transactions), calls)
+    return [order_id for order_id in transactions
+            if order_id not in payments]
+
+
+def post_monthly_sales(since=None):
+    """
+    Post the settled orders ingested since a transaction_date to
+    MonthlySales incrementally. Only the months they arrived late in are
+    rebuilt. Their orders keep no month_to_date until then, so the next
+    sync finds them again if the rebuild is busy elsewhere.
+    """
+
+    late = MonthlySales.post_new(since)
+    if late:
+        logger.info('Rebuilding %d months with late orders', len(late))
+        recompute_monthly_sales(late)
+
+
+def recompute_monthly_sales(months):
+    """
+    Rebuild MonthlySales and rewards of the given (year, month). Raises
+    RewardsRecomputeBusyError if another recompute holds the lock for
+    longer than REWARDS_RECOMPUTE_WAIT, so the caller retries them.
+    """
 
-    # offset = Order.objects.filter(transaction_type=order_type).count()
-    sync_order_db(order_type, current_count, offset, test)
+    with hold(REWARDS_RECOMPUTE_LOCK, wait=REWARDS_RECOMPUTE_WAIT) as lease:
+        if lease is None:
+            raise RewardsRecomputeBusyError(months)
+        for year, month in sorted(months):
+            MonthlySales.rebuild(year, month)
+            Order.update_rewards(month, year)
+
+
+def sync_order_db(order_type):
+    """
+    Fetch and ingest the orders created since the last sync, newest first,
+    stopping at the SyncCheckpoint high-water mark. Progress is saved after
+    every page so an interrupted run resumes where it stopped. Returns a
+    report of the pages, rows and seconds it took.
+    """
+
+    started = monotonic()
+    checkpoint = SyncCheckpoint.objects.get_or_create(
+        order_type=order_type)[0]
+    offset = checkpoint.run_offset
+    run_total = checkpoint.run_total
+    if run_total is not None:
+        logger.info('Resuming %s sync at offset %d', order_type, offset)
+
+    # Every order of the run, resumed or not, is newer than the last mark
+    since = None if checkpoint.created_time is None \
+        else datetime.fromtimestamp(checkpoint.created_time, timezone.utc)
+    pages = rows = 0
+    while True:
+        # Orders created since the run started push the older ones down
+        shift = 0 if run_total is None else checkpoint.total - run_total
+        orders, total = fetch_order_page(
+            order_type, offset + max(shift, 0))
+        pages += 1
+        checkpoint.total = total
+        if run_total is None:
+            run_total = total
+            if orders:
+                checkpoint.run_created_time = int(orders[0]['created_time'])
+                checkpoint.run_order_id = orders[0].get('id')
+
+        new_orders = [order for order in orders
+                      if checkpoint.is_newer(order)]
+        if new_orders:
+            rows += ingest_orders(new_orders, order_type)[0]
+
+        offset += len(orders)
+        if not orders or len(new_orders) < len(orders) \
+                or offset >= run_total:
+            break
+        checkpoint.run_offset = offset
+        checkpoint.run_total = run_total
+        checkpoint.save()
+
+    post_monthly_sales(since)
+    checkpoint.complete_run()
+
+    report = {'order_type': order_type, 'pages': pages, 'rows': rows,
+              'elapsed': round(monotonic() - started, 3)}
+    logger.info('Synced %(rows)d %(order_type)s rows from %(pages)d pages '
+                'in %(elapsed).3fs', report)
+    return report
+
+
+def start_backfill(order_type, shard_size, restart=False):
+    """
+    Split the order history into offset shards of shard_size orders.
+    The total at the start of the backfill is kept in redis so the shards
+    stay the same when an interrupted backfill is resumed. Returns the
+    offsets of the shards not completed yet.
+    """
+
+    state_key = BACKFILL_STATE.format(order_type)
+    done_key = BACKFILL_DONE_SHARDS.format(order_type)
+    if restart:
+        redis.delete(state_key, done_key)
+
+    state = redis.hgetall(state_key)
+    if state:
+        total = int(state[b'total'])
+        shard_size = int(state[b'shard_size'])
+        logger.info('Resuming %s backfill of %d orders', order_type, total)
+    else:
+        orders, total = fetch_order_page(order_type)
+        redis.hset(state_key, mapping={
+            'total': total, 'latest_total': total, 'shard_size': shard_size,
+            'created_time': orders[0].get('created_time') if orders else '',
+            'order_id': orders[0].get('id') if orders else ''})
+        redis.delete(done_key)
+        logger.info('Starting %s backfill of %d orders', order_type, total)
+
+    done = {int(offset) for offset in redis.smembers(done_key)}
+    return [offset for offset in range(0, total, shard_size)
+            if offset not in done]
+
+
+def backfill_shard(order_type, shard_offset):
+    """
+    Ingest the orders of a backfill shard. Offsets are relative to the
+    total at the start of the backfill, orders created since push the
+    older ones down. Returns the (year, month) of the settled orders.
+    """
+
+    state_key = BACKFILL_STATE.format(order_type)
+    state = redis.hgetall(state_key)
+    start_total = int(state[b'total'])
+    shard_end = min(shard_offset + int(state[b'shard_size']), start_total)
+
+    offset = shard_offset
+    latest_total = int(state[b'latest_total'])
+    months = set()
+    while offset < shard_end:
+        orders, total = fetch_order_page(
+            order_type, offset + latest_total - start_total)
+        if not orders:
+            break
+        # Orders created while reading shift the page, read again the part
+        # that moved instead of skipping it
+        moved = max(total - latest_total, 0)
+        latest_total = total
+        orders = orders[:shard_end - offset]
+        months |= ingest_orders(orders, order_type)[1]
+        offset += max(len(orders) - moved, 1)
+
+    redis.hset(state_key, 'latest_total', latest_total)
+    redis.sadd(BACKFILL_DONE_SHARDS.format(order_type), shard_offset)
+    return months
+
+
+def finish_backfill(order_type, months):
+    """ Recompute the backfilled months and set the sync high-water mark """
+
+    recompute_monthly_sales(months)
+
+    state_key = BACKFILL_STATE.format(order_type)
+    state = redis.hgetall(state_key)
+    total = int(state[b'total'])
+    shard_size = int(state[b'shard_size'])
+    done = redis.scard(BACKFILL_DONE_SHARDS.format(order_type))
+    if done < len(range(0, total, shard_size)):
+        logger.warning('%s backfill finished with %d of %d shards done',
+                       order_type, done, len(range(0, total, shard_size)))
+        return False
+
+    checkpoint = SyncCheckpoint.objects.get_or_create(
+        order_type=order_type)[0]
+    if checkpoint.created_time is None and state[b'created_time']:
+        checkpoint.created_time = int(state[b'created_time'])
+        checkpoint.order_id = state[b'order_id'].decode()
+        checkpoint.save()
+    redis.delete(state_key, BACKFILL_DONE_SHARDS.format(order_type))
+    logger.info('%s backfill of %d orders done', order_type, total)
+    return True
 
 
 def update_outlet_data(phone_number):
+    """
+    Fetch and store the outlet of a phone number not yet in OutletPrefix.
+    Unsupported prefixes are cached for OUTLET_NEGATIVE_CACHE_TTL and only
+    one worker fetches a given prefix, the others wait for its result.
+    Prefixes outside OUTLET_CATALOG_PREFIXES are always fetched.
+    """
+
+    prefix = phone_number[:6]
+    if prefix in settings.OUTLET_CATALOG_PREFIXES \
+            and redis.exists(OUTLET_CATALOG_SYNCED):
+        # The preloaded catalog covers every supported prefix it lists
+        raise serializers.ValidationError('Number is not supported')
+
+    lease = Lease(OUTLET_FETCH_LOCK.format(prefix),
+                  ttl=settings.OUTLET_FETCH_TIMEOUT * 1000)
+    while True:
+        if redis.exists(OUTLET_UNSUPPORTED_PREFIX.format(prefix)):
+            raise serializers.ValidationError('Number is not supported')
+        if lease.acquire():
+            break
+        # Another worker is fetching this prefix, wait for it to finish
+        sleep(OUTLET_FETCH_POLL_INTERVAL)
+        outlet = OutletPrefix.get_outlet(phone_number)
+        if outlet is not None:
+            return outlet
+
     try:
-        resp = coinsph.fetch_outlet_data(phone_number)
+        outlet = OutletPrefix.get_outlet(phone_number)
+        if outlet is not None:
+            return outlet
+        return fetch_outlet_data(phone_number, priority=ratelimit.HIGH)
+    finally:
+        lease.release()
+
+
+def fetch_outlet_data(phone_number, priority=ratelimit.LOW):
+    try:
+        resp = upstream.fetch_outlet_data(phone_number, priority=priority)
     except Exception as e:
         logger.exception(
             "Something went wrong while trying to fetch %s outlet data",
@@ -105,6 +527,8 @@ def update_outlet_data(phone_number):
     try:
         payout_outlet = resp.get('payout-outlets')[0]
     except IndexError:
+        redis.set(OUTLET_UNSUPPORTED_PREFIX.format(phone_number[:6]), 1,
+                  ex=settings.OUTLET_NEGATIVE_CACHE_TTL)
         raise serializers.ValidationError('Number is not supported')
 
     outlet_id = payout_outlet.get('id')
@@ -116,6 +540,82 @@ def update_outlet_data(phone_number):
             pass
         outlet = s.create(s.validated_data)
     finally:
-        outlet.phone_number_prefixes.append(phone_number[:6])
-        outlet.save()
+        outlet.add_prefix(phone_number[:6])
         return outlet
+
+
+def sync_outlet_catalog():
+    """
+    Preload the payout-outlet catalog for every prefix in
+    OUTLET_CATALOG_PREFIXES so product lookups are served locally. Only
+    outlets whose data or prefixes changed are written.
+    """
+
+    payout_outlets = {}
+    outlet_prefixes = {}
+    unsupported = []
+    complete = True
+    for prefix in settings.OUTLET_CATALOG_PREFIXES:
+        phone_number = prefix.ljust(13, '0')
+        try:
+            resp = upstream.fetch_outlet_data(phone_number)
+        except ConnectionError:
+            logger.exception('Unable to fetch %s outlet data', prefix)
+            complete = False
+            continue
+        if resp.status_code != status.HTTP_200_OK:
+            logger.error('Unable to fetch %s outlet data. %s',
+                         prefix, resp.json())
+            complete = False
+            continue
+
+        outlets = resp.json().get('payout-outlets')
+        if not outlets:
+            unsupported.append(prefix)
+            continue
+        payout_outlet = outlets[0]
+        payout_outlets.setdefault(payout_outlet.get('id'), payout_outlet)
+        outlet_prefixes.setdefault(payout_outlet.get('id'), []).append(prefix)
+
+    stored = {outlet.id: outlet for outlet in LoadOutlet.objects.all()}
+    result = {'created': 0, 'updated': 0, 'unchanged': 0,
+              'unsupported': len(unsupported)}
+    for outlet_id, payout_outlet in payout_outlets.items():
+        outlet = stored.get(outlet_id)
+        s = LoadOutletSerializer(outlet, data=payout_outlet)
+        if not s.is_valid():
+            logger.error('Invalid outlet %s data. %s', outlet_id, s.errors)
+            complete = False
+            continue
+
+        prefixes = outlet_prefixes[outlet_id]
+        if outlet is None:
+            outlet = LoadOutlet(phone_number_prefixes=prefixes,
+                                **s.validated_data)
+            outlet.save()
+            result['created'] += 1
+            continue
+
+        if not complete:
+            # Don't drop prefixes based on a partial catalog
+            prefixes = outlet.phone_number_prefixes + prefixes
+        changed = [field for field, value in s.validated_data.items()
+                   if getattr(outlet, field) != value]
+        if changed or set(prefixes) != set(outlet.phone_number_prefixes):
+            for field in changed:
+                setattr(outlet, field, s.validated_data[field])
+            outlet.phone_number_prefixes = prefixes
+            outlet.save()
+            result['updated'] += 1
+        else:
+            result['unchanged'] += 1
+
+    for prefix in unsupported:
+        redis.set(OUTLET_UNSUPPORTED_PREFIX.format(prefix), 1,
+                  ex=settings.OUTLET_NEGATIVE_CACHE_TTL)
+    if complete:
+        redis.set(OUTLET_CATALOG_SYNCED, 1,
+                  ex=settings.OUTLET_CATALOG_SYNCED_TTL)
+
+    logger.info('Outlet catalog synced. %s', result)
+    return result
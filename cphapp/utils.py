@@ -1,5 +1,7 @@
 import pytz
-from datetime import datetime
+from datetime import datetime, time, timedelta
+
+from django.utils.timezone import get_current_timezone
 
 from cph import coinsph
 
@@ -17,6 +19,26 @@ def utc_to_local(utc_datetime, local_tz):
     return local_tz.normalize(local_dt)
 
 
+def month_range(year, month, local_tz=None):
+    """ Return the [start, end) aware datetimes of a local calendar month """
+
+    local_tz = local_tz or get_current_timezone()
+    start = datetime(year, month, 1)
+    if month == 12:
+        end = datetime(year + 1, 1, 1)
+    else:
+        end = datetime(year, month + 1, 1)
+    return local_tz.localize(start), local_tz.localize(end)
+
+
+def day_range(day, local_tz=None):
+    """ Return the [start, end) aware datetimes of a local calendar day """
+
+    local_tz = local_tz or get_current_timezone()
+    start = datetime.combine(day, time())
+    return local_tz.localize(start), local_tz.localize(start + timedelta(1))
+
+
 def find_sell_order_pair(sell_order, entries):
 
     created_at = datetime.fromisoformat(sell_order['created_at'][:-1])
@@ -3,6 +3,5 @@ from __future__ import absolute_import, unicode_literals
 # This will make sure the app is always imported when
 # Django starts so that shared_task will use this app.
 from .celery import app as celery_app
-from eload.fcm_admin import app as fcm_app
 
-__all__ = ('celery_app', 'fcm_app')
+__all__ = ('celery_app',)
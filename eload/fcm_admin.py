@@ -1,10 +1,29 @@
+import threading
+
 from django.conf import settings
 
-import firebase_admin
-from firebase_admin import credentials
+_lock = threading.Lock()
+_app = None
+
+
+def get_app():
+    """
+    Firebase app, initialized on first use so that only the processes
+    sending notifications import firebase_admin and load the credentials.
+    Raises ValueError or OSError if the credentials can't be loaded.
+    """
+
+    global _app
+    if _app is None:
+        with _lock:
+            if _app is None:
+                import firebase_admin
+                from firebase_admin import credentials
 
-try:
-    app = firebase_admin.get_app()
-except ValueError:
-    cred = credentials.Certificate(settings.FCM_PRIVATE_KEY_FILE)
-    app = firebase_admin.initialize_app(cred)
+                try:
+                    _app = firebase_admin.get_app()
+                except ValueError:
+                    cred = credentials.Certificate(
+                        settings.FCM_PRIVATE_KEY_FILE)
+                    _app = firebase_admin.initialize_app(cred)
+    return _app
@@ -214,6 +214,53 @@ CELERY_TIMEZONE = 'Asia/Manila'
 CELERY_IMPORTS = ['cphapp.tasks']
 CELERY_BEAT_SCHEDULER = 'django_celery_beat.schedulers:DatabaseScheduler'
 CELERY_WORKER_HIJACK_ROOT_LOGGER = False
+# Queues, see the worker layout in README.md. Tasks not routed below go to
+# the maintenance queue.
+CELERY_TASK_DEFAULT_QUEUE = 'maintenance'
+CELERY_TASK_ROUTES = {
+    # Finalization of orders retailers are waiting for
+    'cphapp.tasks.poll_pending_orders': {'queue': 'realtime'},
+    'cphapp.tasks.finalize_order': {'queue': 'realtime'},
+    'cphapp.tasks.update_payment_data': {'queue': 'realtime'},
+    'cphapp.tasks.fetch_payment': {'queue': 'realtime'},
+    'cphapp.tasks.apply_payment': {'queue': 'realtime'},
+    'cphapp.tasks.dispatch_outbox': {'queue': 'realtime'},
+    'fcm.tasks.send_confirmation': {'queue': 'notifications'},
+    'fcm.tasks.flush_confirmations': {'queue': 'notifications'},
+    # Order history and payment data of synced orders
+    'cphapp.tasks.sync_order_db': {'queue': 'bulk', 'priority': 9},
+    'cphapp.tasks.backfill_orders': {'queue': 'bulk', 'priority': 9},
+    'cphapp.tasks.backfill_order_shard': {'queue': 'bulk', 'priority': 9},
+    'cphapp.tasks.finish_backfill': {'queue': 'bulk', 'priority': 9},
+    'cphapp.tasks.update_payments_data': {'queue': 'bulk'},
+    'cphapp.tasks.sync_outlet_catalog': {'queue': 'maintenance'},
+    'cphapp.tasks.check_pending_orders': {'queue': 'maintenance'},
+    'fcm.tasks.fcm_check_valid_tokens': {'queue': 'maintenance'},
+}
+# With redis 0 is the highest priority. A worker consuming several queues
+# empties them in the order given to -Q.
+CELERY_TASK_DEFAULT_PRIORITY = 5
+CELERY_BROKER_TRANSPORT_OPTIONS = {
+    'priority_steps': list(range(10)),
+    'queue_order_strategy': 'priority',
+}
+# Reserve a single task per process so a long task never holds others
+# back, workers of short tasks raise it with --prefetch-multiplier
+CELERY_WORKER_PREFETCH_MULTIPLIER = 1
+CELERY_BEAT_SCHEDULE = {
+    'poll_pending_orders': {
+        'task': 'cphapp.tasks.poll_pending_orders',
+        'schedule': 10,  # PENDING_ORDERS_POLL_INTERVAL
+    },
+    'dispatch_outbox': {
+        'task': 'cphapp.tasks.dispatch_outbox',
+        'schedule': 5,
+    },
+    'sync_outlet_catalog': {
+        'task': 'cphapp.tasks.sync_outlet_catalog',
+        'schedule': 6 * 60 * 60,
+    },
+}
 
 try:
     from authentication.auth_settings import *
@@ -225,6 +272,80 @@ except ImportError:
 LOADNINJA_REWARD_TH = {
     'limit': 2e3, 'reward_factor': 0.1, 'reward_factor_onwards': 0.05}
 
+# Calls per second and burst capacity allowed to coins.ph across all
+# workers, per endpoint family
+COINSPH_RATE_LIMITS = {
+    'orders': {'rate': 5, 'capacity': 10},
+    'crypto-payments': {'rate': 5, 'capacity': 10},
+    'payout-outlets': {'rate': 2, 'capacity': 5},
+    'new-order': {'rate': 5, 'capacity': 10},
+}
+# Share of each bucket left to user-facing calls by background ones
+COINSPH_RATE_LIMIT_RESERVE = 0.3
+# Seconds a new order may wait for the rate limiter
+COINSPH_NEW_ORDER_TIMEOUT = 5
+# Pooled HTTP session used for coins.ph calls (see cphapp.session)
+COINSPH_HTTP = {
+    'connect_timeout': 3.05,
+    'read_timeout': 15,
+    'pool_connections': 4,
+    'pool_maxsize': 10,
+    # Retries on connection errors and, by upstream._call, of 5xx
+    # responses of the read endpoints. 429 is left to the caller.
+    'retries': 3,
+    'backoff_factor': 0.5,
+    'max_retry_after': 10,
+    # Send every coins.ph call to this host instead, e.g. the local
+    # stand-in of the runcoinsphstandin command. Never set in production.
+    'base_url': os.getenv('COINSPH_BASE_URL'),
+}
+# Circuit breaker of every endpoint family (see cphapp.circuitbreaker)
+COINSPH_CIRCUIT_BREAKER = {
+    # Failures, each within failure_window seconds of the previous one,
+    # that open the circuit
+    'failure_threshold': 5,
+    'failure_window': 60,
+    # Seconds the circuit stays open before a probe call is let through
+    'open_seconds': 30,
+    # Seconds a probe call may take before another one is allowed
+    'probe_timeout': 20,
+}
+
+# Pending order registry polled by poll_pending_orders (see cphapp.pending)
+# Seconds between polls, keep in sync with CELERY_BEAT_SCHEDULE
+PENDING_ORDERS_POLL_INTERVAL = 10
+# Most orders checked per poll
+PENDING_ORDERS_POLL_LIMIT = 500
+# Most pages of newest orders listed per poll
+PENDING_ORDERS_MAX_PAGES = 5
+# Seconds to the first check of an order and longest between two checks
+PENDING_ORDERS_BACKOFF = (5, 6 * 60)
+# Seconds an order is polled before sync_order_db is left to finalize it
+PENDING_ORDERS_MAX_AGE = 24 * 60 * 60
+
+# Most pages of newest crypto-payments listed per payments reconciliation
+PAYMENTS_RECONCILE_MAX_PAGES = 10
+# Fetch payment data inside LoadTransaction post_save instead of through
+# the outbox. For tests only, it blocks the saving request.
+PAYMENT_DATA_EAGER = False
+
+# Seconds transaction confirmations are buffered before they are sent
+FCM_CONFIRMATION_WINDOW = 2
+# Send a single digest to a retailer with several confirmations buffered
+FCM_CONFIRMATION_DIGEST = True
+# Seconds between two checks of the FCM tokens of a retailer
+FCM_TOKEN_CHECK_INTERVAL = 60 * 60
+
+# Seconds to remember that a phone number prefix is not supported
+OUTLET_NEGATIVE_CACHE_TTL = 60 * 60
+# Seconds a worker may hold a prefix while fetching its outlet data
+OUTLET_FETCH_TIMEOUT = 10
+# Phone number prefixes preloaded by the sync_outlet_catalog task
+OUTLET_CATALOG_PREFIXES = [f'+639{n:02d}' for n in range(100)]
+# Seconds a complete catalog sync is trusted to cover every supported
+# prefix, past that unknown prefixes are fetched from coins.ph again
+OUTLET_CATALOG_SYNCED_TTL = 2 * 24 * 60 * 60
+
 # Try to import api keys if present
 try:
     from eload.api_keys import *
@@ -9,7 +9,7 @@ from rest_framework.permissions import IsAuthenticated
 
 from fcm.models import FCMDevice
 from fcm.api.serializers import FCMDeviceSerializer
-from fcm.tasks import fcm_check_valid_tokens
+from fcm.tasks import schedule_token_check
 
 
 class FCMConfigRetrieveAPIView(APIView):
@@ -50,8 +50,9 @@ class FCMDeviceAPIViewSet(viewsets.GenericViewSet,
             obj = serializer.create(serializer.validated_data)
             status_code = status.HTTP_201_CREATED
 
-        # Launch FCMToken-checking task
-        fcm_check_valid_tokens.apply_async(kwargs={'owner_id': owner.id})
+        if status_code == status.HTTP_201_CREATED:
+            # Launch FCMToken-checking task
+            schedule_token_check(owner.id)
 
         serializer = FCMDeviceSerializer(obj)
         return Response(data=serializer.data, status=status_code)
@@ -1,60 +1,173 @@
 import logging
+from collections import defaultdict
 
 from celery import shared_task
-from firebase_admin import messaging
-import firebase_admin
+from django.conf import settings
 
 from fcm.models import FCMDevice
-from eload import fcm_app
+from eload import fcm_admin
 
+from cphapp import redis
 from cphapp.models import LoadTransaction
-from cphapp.api.serializers import LoadTransactionSerializer
-from profiles.models import Profile as Retailer
 
 logger = logging.getLogger(__name__)
 
+# IDs used in redis db 1
+PENDING_CONFIRMATIONS = 'fcm.confirmations.pending'
+CONFIRMATIONS_SCHEDULED = 'fcm.confirmations.scheduled'
+
+TOKENS_CHECKED = 'fcm.tokens.checked.{}'
+
+# Most messages per send_all() call allowed by FCM
+SEND_ALL_BATCH_SIZE = 500
+
+# firebase_admin is imported by the functions using it, only the processes
+# sending notifications pay for it (see eload.fcm_admin)
+
+
+def send_all(messages, dry_run=False):
+    """
+    Send messages with send_all() calls of at most SEND_ALL_BATCH_SIZE and
+    delete the tokens FCM reports as no longer valid. Returns the number
+    of messages sent and failed.
+    """
+
+    from firebase_admin import messaging
+
+    # Send errors meaning a token will never be valid again
+    dead_token_errors = (messaging.UnregisteredError,
+                         messaging.SenderIdMismatchError)
+    app = fcm_admin.get_app()
+    success = failure = 0
+    dead_tokens = set()
+    for i in range(0, len(messages), SEND_ALL_BATCH_SIZE):
+        batch = messages[i:i + SEND_ALL_BATCH_SIZE]
+        resp = messaging.send_all(batch, dry_run=dry_run, app=app)
+        success += resp.success_count
+        failure += resp.failure_count
+        dead_tokens.update(
+            message.token for message, r in zip(batch, resp.responses)
+            if isinstance(r.exception, dead_token_errors))
+
+    if dead_tokens:
+        deleted = FCMDevice.objects.filter(token__in=dead_tokens).delete()[0]
+        logger.info('Deleted %d unregistered tokens', deleted)
+    return success, failure
+
+
+def schedule_token_check(owner_id):
+    """ Check the tokens of owner_id at most every FCM_TOKEN_CHECK_INTERVAL """
+
+    if redis.set(TOKENS_CHECKED.format(owner_id), 1, nx=True,
+                 ex=settings.FCM_TOKEN_CHECK_INTERVAL):
+        fcm_check_valid_tokens.apply_async(kwargs={'owner_id': owner_id})
+
 
 @shared_task(ignore_result=True)
 def fcm_check_valid_tokens(owner_id):
-    for token in FCMDevice.objects.filter(owner__id=owner_id):
-        message = messaging.Message(token=token.token)
-        try:
-            messaging.send(message, dry_run=True, app=fcm_app)
-        except messaging.UnregisteredError:
-            logger.info('Deleting unregistered token: ', token.token)
-            token.delete()
+    """ Validate every token of owner_id with batched dry-run sends """
+
+    from firebase_admin import messaging
+
+    tokens = FCMDevice.objects.filter(owner__id=owner_id).values_list(
+        'token', flat=True)
+    send_all([messaging.Message(token=token) for token in tokens],
+             dry_run=True)
 
 
 @shared_task(ignore_result=True)
 def send_confirmation(order_id):
-    """ Send notification confirming transaction result and status """
+    """
+    Queue the notification confirming a transaction result and status.
+    Confirmations are sent FCM_CONFIRMATION_WINDOW seconds after the first
+    one queued, all at once by flush_confirmations.
+    """
+
+    redis.rpush(PENDING_CONFIRMATIONS, order_id)
+    if redis.set(CONFIRMATIONS_SCHEDULED, 1, nx=True,
+                 ex=settings.FCM_CONFIRMATION_WINDOW * 10):
+        flush_confirmations.apply_async(
+            countdown=settings.FCM_CONFIRMATION_WINDOW)
+
+
+@shared_task(ignore_result=True)
+def flush_confirmations():
+    # Confirmations queued from now on schedule another flush
+    redis.delete(CONFIRMATIONS_SCHEDULED)
+    queued = redis.lrange(PENDING_CONFIRMATIONS, 0, -1)
+    order_ids = list(dict.fromkeys(order_id.decode() for order_id in queued))
+    if not order_ids:
+        return
 
     try:
-        firebase_admin.get_app()
-    except ValueError:
-        # Just return if there is no initialized firebase app
+        fcm_admin.get_app()
+    except (ValueError, OSError):
+        # Just drop them if firebase can't be initialized
+        logger.warning('Unable to initialize the firebase app')
+        redis.ltrim(PENDING_CONFIRMATIONS, len(queued), -1)
         return
+    from firebase_admin import messaging
+
+    transactions = LoadTransaction.objects.filter(
+        order_id__in=order_ids, retailer__isnull=False).only(
+        'id', 'order_id', 'retailer_id', 'status', 'amount', 'product_code',
+        'phone_number', 'transaction_date')
+    by_retailer = defaultdict(list)
+    for transaction in transactions:
+        by_retailer[transaction.retailer_id].append(transaction)
+
+    tokens = defaultdict(list)
+    for owner_id, token in FCMDevice.objects.filter(
+            owner_id__in=by_retailer).values_list('owner_id', 'token'):
+        tokens[owner_id].append(token)
+
+    messages = []
+    for retailer_id, retailer_transactions in by_retailer.items():
+        if not tokens[retailer_id]:
+            logger.info('Unable to send notification for retailer %s',
+                        retailer_id)
+            continue
+        if settings.FCM_CONFIRMATION_DIGEST \
+                and len(retailer_transactions) > 1:
+            notifications = [digest_notification(retailer_transactions)]
+        else:
+            notifications = [confirmation_notification(transaction)
+                             for transaction in retailer_transactions]
+        messages.extend(
+            messaging.Message(token=token, data=data, webpush=webpush)
+            for data, webpush in notifications
+            for token in tokens[retailer_id])
+
+    # Popped once the messages are built, those queued meanwhile are kept
+    redis.ltrim(PENDING_CONFIRMATIONS, len(queued), -1)
+    success, failure = send_all(messages)
+    logger.info('%d confirmations to %d retailers sent as %d messages. '
+                'Success: %i, Failed: %i', len(order_ids), len(by_retailer),
+                len(messages), success, failure)
+
+
+def _webpush_config(title, body, icon):
+    from firebase_admin import messaging
 
-    obj = LoadTransaction.objects.get(order_id=order_id)
-    data = LoadTransactionSerializer(obj).data
+    wp_notification = messaging.WebpushNotification(
+        title=title, body=body,
+        icon=f'/static/img/icons/{icon}')
+    wp_config = messaging.WebpushConfig(notification=wp_notification)
+    wp_config.fcm_options = messaging.WebpushFCMOptions(
+        link='https://www.loadninja.xyz')
+    return wp_config
 
-    # Get retailer fcm tokens
-    retailer = Retailer.objects.get(pk=data.get('retailer'))
-    token_qs = retailer.fcmdevices.all()
-    if not token_qs.exists():
-        logger.info('Unable to send notification for retailer ',
-                    retailer.username)
-        return
 
-    product_code = data.get('product_code')
-    phone_number = data.get('phone_number')
+def confirmation_notification(transaction):
+    """ Data and webpush config of a transaction confirmation """
 
-    if product_code == 'regular':
-        product = f'P{data.get("amount")} amount of regular load'
+    if transaction.product_code == 'regular':
+        product = f'P{transaction.amount} amount of regular load'
     else:
-        product = product_code
+        product = transaction.product_code
+    phone_number = transaction.phone_number
 
-    if data.get('status') == 'settled':
+    if transaction.status == 'settled':
         title = 'Transaction successful!'
         body = (f'You successfully send {product} to {phone_number}. Thank '
                 'you for using LoadNinja.')
@@ -65,24 +178,41 @@ def send_confirmation(order_id):
                 'unsuccessful. Please try again later.')
         icon = 'notification-failed.png'
 
-    # Compose notification objects
-    wp_notification = messaging.WebpushNotification(
-        title=title, body=body,
-        icon=f'/static/img/icons/{icon}')
-    wp_config = messaging.WebpushConfig(notification=wp_notification)
-    # if not settings.DEBUG:
-    fcm_options = messaging.WebpushFCMOptions(
-        link='https://www.loadninja.xyz')
-    wp_config.fcm_options = fcm_options
-
-    tokens = [t.get('token') for t in token_qs.values('token')]
-    data = {k: str(v) for k, v in data.items()}
-    data['notification_type'] = 'NEW_TRANSACTION'
-    data['notification_status'] = 'SUCCESS' if data.get(
-        'status') == 'settled' else 'ERROR'
-    messages = messaging.MulticastMessage(tokens, data=data, webpush=wp_config)
-    logger.info('Sending notification to retailer %s ...',
-                retailer.user.username)
-    resp = messaging.send_multicast(messages)
-    logger.info('Notification status. Success: %i, Failed: %i',
-                resp.success_count, resp.failure_count)
+    # Only what the client needs to show the result, it fetches the rest
+    data = {
+        'id': str(transaction.id),
+        'order_id': transaction.order_id,
+        'status': str(transaction.status),
+        'amount': str(transaction.amount),
+        'product_code': str(transaction.product_code),
+        'phone_number': str(phone_number),
+        'transaction_date': transaction.transaction_date.isoformat()
+        if transaction.transaction_date else '',
+        'notification_type': 'NEW_TRANSACTION',
+        'notification_status': 'SUCCESS'
+        if transaction.status == 'settled' else 'ERROR',
+    }
+    return data, _webpush_config(title, body, icon)
+
+
+def digest_notification(transactions):
+    """ Data and webpush config of a single confirmation of transactions """
+
+    settled = sum(1 for t in transactions if t.status == 'settled')
+    failed = len(transactions) - settled
+    if not failed:
+        title = f'{settled} transactions successful!'
+        body = 'Thank you for using LoadNinja.'
+        icon = 'notification-success.png'
+    else:
+        title = f'{failed} of {len(transactions)} transactions failed!'
+        body = (f'{settled} successful, {failed} unsuccessful. Please try '
+                'again later.')
+        icon = 'notification-failed.png'
+
+    data = {
+        'order_ids': ','.join(t.order_id for t in transactions),
+        'notification_type': 'TRANSACTION_DIGEST',
+        'notification_status': 'ERROR' if failed else 'SUCCESS',
+    }
+    return data, _webpush_config(title, body, icon)
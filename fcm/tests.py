@@ -1,12 +1,20 @@
+import os
+import subprocess
+import sys
+
 from django.urls import reverse
 from django.contrib.auth import get_user_model
 from django.conf import settings
+from django.test import SimpleTestCase
+from django.utils.timezone import now
 
 from rest_framework.test import APITestCase
 from rest_framework import status
 from rest_framework.authtoken.models import Token
 
+from cphapp.models import LoadTransaction
 from cphapp.test_assets.defines import USERA, USERB
+from fcm.tasks import confirmation_notification, digest_notification
 
 USER_MODEL = get_user_model()
 
@@ -47,3 +55,58 @@ class FCMConfigAPITestCase(FCMAPITestCase):
         response = self.client.get(endpoint)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertTrue(response.data == settings.FCM_CONFIG)
+
+
+class ConfirmationNotificationTestCase(SimpleTestCase):
+
+    def _transaction(self, order_id, status):
+        return LoadTransaction(
+            order_id=order_id, status=status, amount=10,
+            product_code='regular', phone_number='+639171234567',
+            transaction_date=now())
+
+    def test_payloads(self):
+        data, webpush = confirmation_notification(
+            self._transaction('order-a', 'settled'))
+        self.assertEqual(data['notification_status'], 'SUCCESS')
+        self.assertTrue(all(isinstance(v, str) for v in data.values()))
+        self.assertNotIn('sold_this_month', data)
+
+        data, webpush = digest_notification([
+            self._transaction('order-a', 'settled'),
+            self._transaction('order-b', 'expired')])
+        self.assertEqual(data['order_ids'], 'order-a,order-b')
+        self.assertEqual(data['notification_status'], 'ERROR')
+        self.assertEqual(webpush.notification.title,
+                         '1 of 2 transactions failed!')
+
+    def test_no_transaction_date(self):
+        transaction = self._transaction('order-a', 'expired')
+        transaction.transaction_date = None
+        data, webpush = confirmation_notification(transaction)
+        self.assertEqual(data['transaction_date'], '')
+
+
+class LazyImportTestCase(SimpleTestCase):
+    """
+    Firebase is only loaded by the processes sending notifications, not
+    by what every web worker and management command imports. Checked in a
+    fresh interpreter. The import time itself is reported by the
+    measureimporttime command.
+    """
+
+    LAZY_PACKAGES = ('firebase_admin', 'grpc', 'google.cloud')
+    CODE = ('import sys, django; django.setup(); '
+            'import eload.urls, cphapp.tasks, fcm.tasks; '
+            "print('\\n'.join(sys.modules))")
+
+    def test_firebase_not_imported(self):
+        result = subprocess.run(
+            [sys.executable, '-c', self.CODE],
+            cwd=settings.BASE_DIR, stdout=subprocess.PIPE,
+            universal_newlines=True, check=True,
+            env=dict(os.environ, DJANGO_SETTINGS_MODULE='eload.settings'))
+
+        imported = set(result.stdout.splitlines())
+        for package in self.LAZY_PACKAGES:
+            self.assertNotIn(package, imported)